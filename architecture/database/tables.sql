@@ -7,6 +7,13 @@ DROP TABLE IF EXISTS track_artist;
 DROP TABLE IF EXISTS artist;
 DROP TABLE IF EXISTS genre;
 DROP TABLE IF EXISTS track;
+DROP TABLE IF EXISTS spotify_response_cache;
+DROP TABLE IF EXISTS tiktok_track_resolution;
+DROP TABLE IF EXISTS popularity_work_queue;
+DROP TABLE IF EXISTS poll_schedule;
+DROP TABLE IF EXISTS tiktok_handle;
+DROP TABLE IF EXISTS tiktok_refresh_state;
+DROP TABLE IF EXISTS tiktok_refresh_checkpoint;
 
 
 CREATE TABLE IF NOT EXISTS track (
@@ -41,6 +48,8 @@ CREATE TABLE IF NOT EXISTS artist_popularity (
     FOREIGN KEY(artist_spotify_id) REFERENCES artist(artist_spotify_id)
 );
 
+CREATE INDEX IF NOT EXISTS artist_popularity_latest ON artist_popularity (artist_spotify_id, created_at DESC);
+
 CREATE TABLE IF NOT EXISTS genre (
     genre_id INT GENERATED ALWAYS AS IDENTITY,
     genre_name VARCHAR(100) UNIQUE,
@@ -65,6 +74,8 @@ CREATE TABLE IF NOT EXISTS track_popularity (
     FOREIGN KEY(track_spotify_id) REFERENCES track(track_spotify_id)
 );
 
+CREATE INDEX IF NOT EXISTS track_popularity_latest ON track_popularity (track_spotify_id, created_at DESC);
+
 CREATE TABLE IF NOT EXISTS track_artist (
     track_artist_id INT GENERATED ALWAYS AS IDENTITY,
     track_spotify_id VARCHAR(200) NOT NULL,
@@ -86,3 +97,74 @@ CREATE TABLE IF NOT EXISTS tiktok_artist_views(
     artist_tiktok_like_count_in_hundred_thousands INT,
     recorded_at TIMESTAMP NOT NULL DEFAULT current_timestamp
 );
+
+CREATE TABLE IF NOT EXISTS spotify_response_cache(
+    endpoint VARCHAR(50) NOT NULL,
+    entity_id VARCHAR(200) NOT NULL,
+    response JSONB NOT NULL,
+    fetched_at TIMESTAMP NOT NULL DEFAULT current_timestamp,
+    PRIMARY KEY(endpoint, entity_id)
+);
+
+CREATE TABLE IF NOT EXISTS tiktok_track_resolution(
+    normalised_title VARCHAR(200) NOT NULL,
+    normalised_artist VARCHAR(200) NOT NULL,
+    track_spotify_id VARCHAR(200),
+    track_artists JSONB,
+    search_strategy VARCHAR(20),
+    resolved_at TIMESTAMP NOT NULL DEFAULT current_timestamp,
+    retry_after DATE,
+    PRIMARY KEY(normalised_title, normalised_artist)
+);
+
+CREATE TABLE IF NOT EXISTS popularity_work_queue(
+    batch_id INT GENERATED ALWAYS AS IDENTITY,
+    run_timestamp TIMESTAMP NOT NULL,
+    entity_type VARCHAR(10) NOT NULL,
+    spotify_ids VARCHAR(200)[] NOT NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    leased_until TIMESTAMP,
+    completed_at TIMESTAMP,
+    PRIMARY KEY(batch_id)
+);
+
+CREATE INDEX IF NOT EXISTS popularity_work_queue_pending ON popularity_work_queue (batch_id)
+    WHERE completed_at IS NULL;
+
+CREATE TABLE IF NOT EXISTS poll_schedule(
+    entity_type VARCHAR(10) NOT NULL,
+    spotify_id VARCHAR(200) NOT NULL,
+    volatility FLOAT,
+    poll_interval INTERVAL NOT NULL DEFAULT '1 hour',
+    last_polled_at TIMESTAMP,
+    PRIMARY KEY(entity_type, spotify_id)
+);
+
+CREATE TABLE IF NOT EXISTS tiktok_handle(
+    artist_spotify_id VARCHAR(200) NOT NULL,
+    tiktok_handle VARCHAR(100),
+    confidence FLOAT,
+    source VARCHAR(10) NOT NULL,
+    failure_count INT NOT NULL DEFAULT 0,
+    retry_after TIMESTAMP,
+    last_checked_at TIMESTAMP,
+    PRIMARY KEY(artist_spotify_id)
+);
+
+CREATE TABLE IF NOT EXISTS tiktok_refresh_state(
+    entity_type VARCHAR(10) NOT NULL,
+    spotify_id VARCHAR(200) NOT NULL,
+    last_refreshed_at TIMESTAMP NOT NULL,
+    last_value FLOAT,
+    growth FLOAT,
+    PRIMARY KEY(entity_type, spotify_id)
+);
+
+CREATE TABLE IF NOT EXISTS tiktok_refresh_checkpoint(
+    run_key VARCHAR(50) NOT NULL,
+    started_at TIMESTAMP NOT NULL DEFAULT current_timestamp,
+    refreshed_count INT NOT NULL DEFAULT 0,
+    last_flushed_at TIMESTAMP,
+    completed_at TIMESTAMP,
+    PRIMARY KEY(run_key)
+);
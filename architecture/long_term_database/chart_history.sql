@@ -0,0 +1,14 @@
+CREATE TABLE IF NOT EXISTS chart_history(
+    entity_type VARCHAR(10) NOT NULL,
+    spotify_id VARCHAR(200) NOT NULL,
+    first_seen_at TIMESTAMP NOT NULL DEFAULT current_timestamp,
+    PRIMARY KEY(entity_type, spotify_id)
+);
+
+INSERT INTO chart_history (entity_type, spotify_id, first_seen_at)
+    SELECT 'track', track_spotify_id, recorded_at FROM track
+    ON CONFLICT DO NOTHING;
+
+INSERT INTO chart_history (entity_type, spotify_id, first_seen_at)
+    SELECT 'artist', artist_spotify_id, recorded_at FROM artist
+    ON CONFLICT DO NOTHING;
@@ -1,4 +1,5 @@
 import os
+import sys
 import psycopg2
 from psycopg2.extensions import connection
 from dotenv import load_dotenv
@@ -20,10 +21,10 @@ def get_db_connection():
         print("Error connecting to database.")
 
 
-def create_tables(conn: connection) -> None:
-    """Creates tables in the long-term database"""
+def create_tables(conn: connection, sql_file: str = "./long_term.sql") -> None:
+    """Creates tables in the long-term database, or runs the given migration file"""
     with conn.cursor() as cur:
-        with open(f"./long_term.sql", "r", encoding='utf-8') as sql:
+        with open(sql_file, "r", encoding='utf-8') as sql:
             cur.execute(sql.read())
     conn.commit()
 
@@ -31,4 +32,7 @@ def create_tables(conn: connection) -> None:
 if __name__ == "__main__":
     load_dotenv()
     conn = get_db_connection()
-    create_tables(conn)
\ No newline at end of file
+    if len(sys.argv) > 1:
+        create_tables(conn, sys.argv[1])
+    else:
+        create_tables(conn)
\ No newline at end of file
@@ -0,0 +1,7 @@
+DELETE FROM track_artist AS duplicate
+    USING track_artist AS kept
+    WHERE duplicate.track_spotify_id = kept.track_spotify_id
+    AND duplicate.artist_spotify_id = kept.artist_spotify_id
+    AND duplicate.track_artist_id > kept.track_artist_id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS track_artist_pair ON track_artist (track_spotify_id, artist_spotify_id);
@@ -6,6 +6,7 @@ DROP TABLE IF EXISTS tiktok_track_views;
 DROP TABLE IF EXISTS track_artist;
 DROP TABLE IF EXISTS artist;
 DROP TABLE IF EXISTS track;
+DROP TABLE IF EXISTS chart_history;
 
 CREATE TABLE track (
     track_spotify_id VARCHAR(200) NOT NULL,
@@ -41,6 +42,8 @@ CREATE TABLE artist_popularity (
     FOREIGN KEY(artist_spotify_id) REFERENCES artist(artist_spotify_id)
 );
 
+CREATE INDEX artist_popularity_latest ON artist_popularity (artist_spotify_id, created_at DESC);
+
 CREATE TABLE track_popularity (
     track_popularity_id INT GENERATED ALWAYS AS IDENTITY,
     track_spotify_id VARCHAR(200) NOT NULL,
@@ -50,6 +53,8 @@ CREATE TABLE track_popularity (
     FOREIGN KEY(track_spotify_id) REFERENCES track(track_spotify_id)
 );
 
+CREATE INDEX track_popularity_latest ON track_popularity (track_spotify_id, created_at DESC);
+
 CREATE TABLE track_artist (
     track_artist_id INT GENERATED ALWAYS AS IDENTITY,
     track_spotify_id VARCHAR(200) NOT NULL,
@@ -59,15 +64,28 @@ CREATE TABLE track_artist (
     FOREIGN KEY(artist_spotify_id) REFERENCES artist(artist_spotify_id)
 );
 
+CREATE UNIQUE INDEX track_artist_pair ON track_artist (track_spotify_id, artist_spotify_id);
+
 CREATE TABLE tiktok_track_views(
     track_spotify_id VARCHAR(200) NOT NULL,
     tiktok_track_views_in_hundred_thousands FLOAT,
     recorded_at TIMESTAMP NOT NULL
 );
 
+CREATE INDEX tiktok_track_views_recorded ON tiktok_track_views (track_spotify_id, recorded_at);
+
 CREATE TABLE tiktok_artist_views(
     artist_spotify_id VARCHAR(200) NOT NULL,
     artist_tiktok_follower_count_in_hundred_thousands INT,
     artist_tiktok_like_count_in_hundred_thousands INT,
     recorded_at TIMESTAMP NOT NULL
 );
+
+CREATE INDEX tiktok_artist_views_recorded ON tiktok_artist_views (artist_spotify_id, recorded_at);
+
+CREATE TABLE chart_history(
+    entity_type VARCHAR(10) NOT NULL,
+    spotify_id VARCHAR(200) NOT NULL,
+    first_seen_at TIMESTAMP NOT NULL DEFAULT current_timestamp,
+    PRIMARY KEY(entity_type, spotify_id)
+);
@@ -0,0 +1,3 @@
+CREATE INDEX IF NOT EXISTS tiktok_track_views_recorded ON tiktok_track_views (track_spotify_id, recorded_at);
+
+CREATE INDEX IF NOT EXISTS tiktok_artist_views_recorded ON tiktok_artist_views (artist_spotify_id, recorded_at);
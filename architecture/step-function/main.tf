@@ -132,15 +132,17 @@ resource "aws_lambda_function" "spotify-tiktok-extract" {
 
   environment {
     variables = {
-      DB_PORT       = 5432
-      DB_USER       = var.DB_USER
-      DB_HOST       = var.DB_HOST
-      DB_NAME       = var.DB_NAME
-      DB_PASSWORD   = var.DB_PASSWORD
-      ACCESS_KEY_ID = var.ACCESS_KEY_ID
-      SECRET_KEY_ID = var.SECRET_KEY_ID
-      CLIENT_ID     = var.CLIENT_ID
-      CLIENT_SECRET = var.CLIENT_SECRET
+      DB_PORT           = 5432
+      DB_USER           = var.DB_USER
+      DB_HOST           = var.DB_HOST
+      DB_NAME           = var.DB_NAME
+      DB_PASSWORD       = var.DB_PASSWORD
+      ACCESS_KEY_ID     = var.ACCESS_KEY_ID
+      SECRET_KEY_ID     = var.SECRET_KEY_ID
+      CLIENT_ID         = var.CLIENT_ID
+      CLIENT_SECRET     = var.CLIENT_SECRET
+      DB_LONG_TERM_NAME = var.DB_LONG_TERM_NAME
+      DB_LONG_TERM_HOST = var.DB_LONG_TERM_HOST
     }
   }
 }
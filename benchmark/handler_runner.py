@@ -0,0 +1,74 @@
+"""Runs one lambda handler in its own process and reports its wall time and DB round trips"""
+import json
+import os
+import sys
+import time
+from functools import partial
+import psycopg2
+from psycopg2.extensions import connection, cursor
+
+
+RESULT_MARKER = "BENCHMARK_RESULT "
+COUNTS = {"db_round_trips": 0}
+COUNTING_CURSORS = {}
+
+
+def get_counting_cursor(cursor_factory: type) -> type:
+    """Returns a subclass of the given cursor class that counts statements sent to the server"""
+    if cursor_factory not in COUNTING_CURSORS:
+        def execute(self, query, vars=None):
+            COUNTS["db_round_trips"] += 1
+            return cursor_factory.execute(self, query, vars)
+
+        def executemany(self, query, vars_list):
+            vars_list = list(vars_list)
+            COUNTS["db_round_trips"] += len(vars_list)
+            return cursor_factory.executemany(self, query, vars_list)
+
+        def copy_expert(self, sql, file, size=8192):
+            COUNTS["db_round_trips"] += 1
+            return cursor_factory.copy_expert(self, sql, file, size)
+
+        COUNTING_CURSORS[cursor_factory] = type(f"Counting{cursor_factory.__name__}",
+                                                (cursor_factory,),
+                                                {"execute": execute, "executemany": executemany,
+                                                 "copy_expert": copy_expert})
+    return COUNTING_CURSORS[cursor_factory]
+
+
+class CountingConnection(connection):
+    """Connection whose cursors, commits and rollbacks are counted as round trips"""
+
+    def cursor(self, *args, **kwargs):
+        cursor_factory = kwargs.get("cursor_factory") or self.cursor_factory or cursor
+        kwargs["cursor_factory"] = get_counting_cursor(cursor_factory)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        COUNTS["db_round_trips"] += 1
+        return super().commit()
+
+    def rollback(self):
+        COUNTS["db_round_trips"] += 1
+        return super().rollback()
+
+
+def run_handler(lambda_dir: str, module_name: str, event: dict) -> dict:
+    """Imports a lambda's handler module from its directory and times one invocation"""
+    psycopg2.connect = partial(psycopg2.connect, connection_factory=CountingConnection)
+    sys.path.insert(0, lambda_dir)
+    os.chdir(lambda_dir)
+    module = __import__(module_name)
+    start = time.perf_counter()
+    result = module.handler(event, None)
+    wall_time = time.perf_counter() - start
+    if not isinstance(result, dict):
+        result = {}
+    status = result.get("status_code", result.get("status code"))
+    return {"wall_time": wall_time, "db_round_trips": COUNTS["db_round_trips"],
+            "status": str(status)}
+
+
+if __name__ == "__main__":
+    handler_result = run_handler(sys.argv[1], sys.argv[2], json.loads(sys.argv[3]))
+    print(RESULT_MARKER + json.dumps(handler_result))
@@ -0,0 +1,184 @@
+"""Local stand-in for Spotify, Tokchart and TikTok that records and replays responses"""
+import argparse
+import base64
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests import request
+
+
+UPSTREAMS = {
+    "spotify": "https://api.spotify.com",
+    "accounts": "https://accounts.spotify.com",
+    "tokchart": "https://tokchart.com",
+    "tiktok": "https://www.tiktok.com"
+}
+RATE_LIMITED_UPSTREAMS = ["spotify"]
+FORWARDED_HEADERS = ["Authorization", "Content-Type", "User-Agent"]
+
+
+def load_archive(archive_path: str) -> dict:
+    """Loads a gzipped fixture archive of recorded responses"""
+    with gzip.open(archive_path, "rt", encoding="utf-8") as archive:
+        return json.load(archive)
+
+
+def save_archive(archive_path: str, responses: dict) -> None:
+    """Saves recorded responses to a gzipped fixture archive"""
+    with gzip.open(archive_path, "wt", encoding="utf-8") as archive:
+        json.dump(responses, archive)
+
+
+def get_env_overrides(base_url: str) -> dict:
+    """Returns the environment variables that point the lambdas at the server"""
+    return {
+        "SPOTIFY_BASE_URL": f"{base_url}/spotify/v1/",
+        "SPOTIFY_TOKEN_URL": f"{base_url}/accounts/api/token",
+        "TOKCHARTS_BASE_URL": f"{base_url}/tokchart/?page=",
+        "TIKTOK_TAG_URL": f"{base_url}/tiktok/tag/",
+        "TIKTOK_ARTIST_URL": f"{base_url}/tiktok/@"
+    }
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+    Serves recorded responses keyed by method and path. In record mode requests
+    are forwarded to the real upstream and the responses are kept for saving
+    """
+    daemon_threads = True
+
+    def __init__(self, address: tuple, responses: dict = None, record: bool = False,
+                 latency_ms: int = 0, rate_limit_every: int = 0, retry_after: int = 1):
+        super().__init__(address, ReplayHandler)
+        self.responses = responses if responses is not None else {}
+        self.record = record
+        self.latency_ms = latency_ms
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        """Zeroes the request counters"""
+        with self.lock:
+            self.stats = {"requests": 0, "by_upstream": {}, "rate_limited": 0, "missing": 0}
+
+    def count_request(self, upstream: str) -> int:
+        """Counts a request and returns how many have been made to its upstream"""
+        with self.lock:
+            self.stats["requests"] += 1
+            count = self.stats["by_upstream"].get(upstream, 0) + 1
+            self.stats["by_upstream"][upstream] = count
+            return count
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    """Handles a single request against the replay server"""
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def log_message(self, format, *args):
+        return None
+
+    def send_body(self, status: int, content_type: str, body: bytes, headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self):
+        server = self.server
+        if self.path == "/__stats__":
+            with server.lock:
+                body = json.dumps(server.stats).encode("utf-8")
+            return self.send_body(200, "application/json", body)
+        if self.path == "/__reset__":
+            server.reset_stats()
+            return self.send_body(200, "application/json", b"{}")
+
+        upstream, _, upstream_path = self.path.lstrip("/").partition("/")
+        if upstream not in UPSTREAMS:
+            return self.send_body(404, "text/plain", b"Unknown upstream")
+        count = server.count_request(upstream)
+        if server.latency_ms > 0:
+            time.sleep(server.latency_ms / 1000)
+        if server.rate_limit_every > 0 and upstream in RATE_LIMITED_UPSTREAMS \
+                and count % server.rate_limit_every == 0:
+            with server.lock:
+                server.stats["rate_limited"] += 1
+            return self.send_body(429, "application/json",
+                                  b'{"error": {"status": 429, "message": "API rate limit exceeded"}}',
+                                  {"Retry-After": str(server.retry_after)})
+
+        key = f"{self.command} {upstream}/{upstream_path}"
+        if server.record:
+            length = int(self.headers.get("Content-Length", 0))
+            data = self.rfile.read(length) if length > 0 else None
+            headers = {name: self.headers[name] for name in FORWARDED_HEADERS
+                       if self.headers.get(name) is not None}
+            result = request(self.command, f"{UPSTREAMS[upstream]}/{upstream_path}",
+                             headers=headers, data=data, timeout=30)
+            recorded = {"status": result.status_code,
+                        "content_type": result.headers.get("Content-Type", "text/plain"),
+                        "body": base64.b64encode(result.content).decode("utf-8")}
+            with server.lock:
+                server.responses[key] = recorded
+        else:
+            recorded = server.responses.get(key)
+            if recorded is None:
+                with server.lock:
+                    server.stats["missing"] += 1
+                return self.send_body(404, "application/json",
+                                      b'{"error": {"status": 404, "message": "Not recorded"}}')
+        self.send_body(recorded["status"], recorded["content_type"],
+                       base64.b64decode(recorded["body"]))
+
+
+def start_server(responses: dict = None, record: bool = False, latency_ms: int = 0,
+                 rate_limit_every: int = 0, retry_after: int = 1, port: int = 0) -> ReplayServer:
+    """Starts a replay server on a background thread and returns it"""
+    server = ReplayServer(("127.0.0.1", port), responses, record,
+                          latency_ms, rate_limit_every, retry_after)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("archive", help="Fixture archive (.json.gz) to replay or record into")
+    parser.add_argument("--record", action="store_true",
+                        help="Forward requests upstream and save the responses on exit")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=int, default=0)
+    parser.add_argument("--rate-limit-every", type=int, default=0,
+                        help="Answer every Nth Spotify request with a 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+
+    responses = {} if args.record else load_archive(args.archive)
+    server = start_server(responses, args.record, args.latency_ms,
+                          args.rate_limit_every, args.retry_after, args.port)
+    for name, value in get_env_overrides(server.base_url).items():
+        print(f"{name}={value}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+        if args.record:
+            save_archive(args.archive, server.responses)
+            print(f"Saved {len(server.responses)} responses to {args.archive}")
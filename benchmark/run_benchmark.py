@@ -0,0 +1,144 @@
+"""
+Runs the extract lambdas end to end against recorded responses and a throwaway
+Postgres, reporting wall time, request count and DB round trips per handler
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import uuid
+from urllib.request import urlopen
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, make_dsn, parse_dsn
+
+from replay_server import start_server, load_archive, save_archive, get_env_overrides
+from handler_runner import RESULT_MARKER
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HANDLERS = {
+    "daily": ("extract/daily", "spotify_api", {}),
+    "hourly": ("extract/hourly_lambda", "hourly_lambda", {}),
+    "tiktok": ("extract/tiktok_updates", "tiktok_regular_updates", {"message": "Success"})
+}
+SHORT_TERM_SCHEMA = "architecture/database/tables.sql"
+LONG_TERM_SCHEMA = "architecture/long_term_database/long_term.sql"
+
+
+def create_database(admin_dsn: str, db_name: str, schema_path: str) -> None:
+    """Creates a throwaway database and loads a schema file into it"""
+    admin_conn = psycopg2.connect(admin_dsn)
+    admin_conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    with admin_conn.cursor() as cur:
+        cur.execute(f"CREATE DATABASE {db_name};")
+    admin_conn.close()
+    conn = psycopg2.connect(make_dsn(admin_dsn, dbname=db_name))
+    with conn, conn.cursor() as cur:
+        with open(os.path.join(ROOT_DIR, schema_path), "r", encoding="utf-8") as sql:
+            cur.execute(sql.read())
+    conn.close()
+
+
+def drop_database(admin_dsn: str, db_name: str) -> None:
+    """Drops a throwaway database"""
+    admin_conn = psycopg2.connect(admin_dsn)
+    admin_conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    with admin_conn.cursor() as cur:
+        cur.execute(f"DROP DATABASE IF EXISTS {db_name};")
+    admin_conn.close()
+
+
+def get_server_stats(base_url: str, reset: bool = False) -> dict:
+    """Reads (and optionally resets) the replay server's request counters"""
+    with urlopen(f"{base_url}/__stats__") as page:
+        stats = json.loads(page.read())
+    if reset:
+        urlopen(f"{base_url}/__reset__").close()
+    return stats
+
+
+def run_handler(name: str, env: dict, base_url: str) -> dict:
+    """Runs a handler in a fresh process and returns its benchmark result"""
+    lambda_dir, module_name, event = HANDLERS[name]
+    get_server_stats(base_url, reset=True)
+    process = subprocess.run(
+        [sys.executable, os.path.join(ROOT_DIR, "benchmark", "handler_runner.py"),
+         os.path.join(ROOT_DIR, lambda_dir), module_name, json.dumps(event)],
+        env=env, capture_output=True, text=True)
+    result = {"wall_time": None, "db_round_trips": None, "status": "crashed"}
+    for line in process.stdout.splitlines():
+        if line.startswith(RESULT_MARKER):
+            result = json.loads(line[len(RESULT_MARKER):])
+    if result["status"] == "crashed":
+        print(process.stdout)
+        print(process.stderr)
+    stats = get_server_stats(base_url)
+    result["requests"] = stats["requests"]
+    result["rate_limited"] = stats["rate_limited"]
+    result["missing"] = stats["missing"]
+    return result
+
+
+def print_report(results: dict) -> None:
+    """Prints a table of benchmark results"""
+    print(f"{'handler':<10}{'status':>8}{'wall time (s)':>15}{'requests':>10}"
+          f"{'429s':>6}{'missing':>9}{'db round trips':>16}")
+    for name, result in results.items():
+        wall_time = "-" if result["wall_time"] is None else f"{result['wall_time']:.2f}"
+        print(f"{name:<10}{result['status']:>8}{wall_time:>15}{result['requests']:>10}"
+              f"{result['rate_limited']:>6}{result['missing']:>9}"
+              f"{str(result['db_round_trips']):>16}")
+
+
+def main(args) -> dict:
+    """Sets up the server and databases, runs each handler and tears everything down"""
+    responses = {} if args.record else load_archive(args.archive)
+    server = start_server(responses, args.record, args.latency_ms,
+                          args.rate_limit_every, args.retry_after)
+    suffix = uuid.uuid4().hex[:8]
+    short_db = f"bench_short_{suffix}"
+    long_db = f"bench_long_{suffix}"
+    dsn = parse_dsn(args.dsn)
+    env = dict(os.environ)
+    env.update(get_env_overrides(server.base_url))
+    env.update({"DB_USER": dsn.get("user", ""), "DB_PASSWORD": dsn.get("password", ""),
+                "DB_HOST": dsn.get("host", "localhost"), "DB_PORT": dsn.get("port", "5432"),
+                "DB_NAME": short_db, "DB_LONG_TERM_HOST": dsn.get("host", "localhost"),
+                "DB_LONG_TERM_NAME": long_db,
+                "CLIENT_ID": env.get("CLIENT_ID", "benchmark"),
+                "CLIENT_SECRET": env.get("CLIENT_SECRET", "benchmark")})
+    results = {}
+    try:
+        create_database(args.dsn, short_db, SHORT_TERM_SCHEMA)
+        create_database(args.dsn, long_db, LONG_TERM_SCHEMA)
+        for name in args.handlers:
+            print(f"Running {name}...")
+            results[name] = run_handler(name, env, server.base_url)
+    finally:
+        server.shutdown()
+        if not args.keep_databases:
+            drop_database(args.dsn, short_db)
+            drop_database(args.dsn, long_db)
+    if args.record:
+        save_archive(args.archive, server.responses)
+        print(f"Saved {len(server.responses)} responses to {args.archive}")
+    print_report(results)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("archive", help="Fixture archive (.json.gz) to replay or record into")
+    parser.add_argument("--dsn", default=os.getenv("BENCHMARK_DSN", "dbname=postgres"),
+                        help="Connection string for a Postgres server the benchmark may create databases on")
+    parser.add_argument("--handlers", nargs="+", choices=list(HANDLERS),
+                        default=list(HANDLERS))
+    parser.add_argument("--record", action="store_true",
+                        help="Call the live services and save their responses to the archive")
+    parser.add_argument("--latency-ms", type=int, default=0)
+    parser.add_argument("--rate-limit-every", type=int, default=0,
+                        help="Answer every Nth Spotify request with a 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--keep-databases", action="store_true")
+    main(parser.parse_args())
@@ -0,0 +1,104 @@
+"""
+Measures the throughput, in rows per second, of moving each short-term table
+into the long-term database with the COPY transfer engine, then the wall time
+of the whole dependency-ordered parallel migration
+"""
+import argparse
+import os
+import sys
+import time
+import uuid
+import psycopg2
+from psycopg2.extensions import make_dsn
+
+from run_benchmark import ROOT_DIR, SHORT_TERM_SCHEMA, LONG_TERM_SCHEMA, \
+    create_database, drop_database
+
+sys.path.insert(0, os.path.join(ROOT_DIR, "move_to_long_term"))
+from transfer_engine import transfer_table, print_transfer, TABLE_TRANSFERS
+from migration_runner import migrate_tables
+
+
+SYNTHETIC_DATA = [
+    "INSERT INTO track (track_spotify_id, track_name, track_danceability, track_energy, \
+        track_valence, track_tempo, track_speechiness, in_spotify, in_tiktok, spotify_rank) \
+        SELECT 'track' || i, 'Track ' || i, random(), random(), random(), random(), random(), \
+        true, i %% 2 = 0, i %% 100 + 1 FROM generate_series(1, %(entities)s) AS i",
+    "INSERT INTO artist (artist_spotify_id, spotify_name) \
+        SELECT 'artist' || i, 'Artist ' || i FROM generate_series(1, %(entities)s) AS i",
+    "INSERT INTO track_artist (track_spotify_id, artist_spotify_id) \
+        SELECT 'track' || i, 'artist' || i FROM generate_series(1, %(entities)s) AS i",
+    "INSERT INTO track_popularity (track_spotify_id, popularity_score, created_at) \
+        SELECT 'track' || (i %% %(entities)s + 1), i %% 100, \
+        current_timestamp - i * INTERVAL '1 second' FROM generate_series(1, %(rows)s) AS i",
+    "INSERT INTO artist_popularity (artist_spotify_id, artist_popularity, follower_count, \
+        created_at) SELECT 'artist' || (i %% %(entities)s + 1), i %% 100, i, \
+        current_timestamp - i * INTERVAL '1 second' FROM generate_series(1, %(rows)s) AS i",
+    "INSERT INTO tiktok_track_views (track_spotify_id, tiktok_track_views_in_hundred_thousands) \
+        SELECT 'track' || (i %% %(entities)s + 1), random() * 1000 \
+        FROM generate_series(1, %(rows)s) AS i",
+    "INSERT INTO tiktok_artist_views (artist_spotify_id, \
+        artist_tiktok_follower_count_in_hundred_thousands, \
+        artist_tiktok_like_count_in_hundred_thousands) \
+        SELECT 'artist' || (i %% %(entities)s + 1), i %% 1000, i %% 10000 \
+        FROM generate_series(1, %(rows)s) AS i"
+]
+
+
+def fill_short_term(conn, entities: int, rows: int) -> None:
+    """Fills the short-term tables with synthetic tracks, artists and samples"""
+    with conn, conn.cursor() as cur:
+        for sql_query in SYNTHETIC_DATA:
+            cur.execute(sql_query, {"entities": entities, "rows": rows})
+
+
+def main(args) -> dict:
+    """Creates both databases, transfers every table in each format and tears down"""
+    suffix = uuid.uuid4().hex[:8]
+    results = {}
+    for copy_format in args.formats:
+        short_db = f"bench_transfer_short_{suffix}"
+        long_db = f"bench_transfer_long_{suffix}"
+        try:
+            create_database(args.dsn, short_db, SHORT_TERM_SCHEMA)
+            create_database(args.dsn, long_db, LONG_TERM_SCHEMA)
+            short_conn = psycopg2.connect(make_dsn(args.dsn, dbname=short_db))
+            long_conn = psycopg2.connect(make_dsn(args.dsn, dbname=long_db))
+            fill_short_term(short_conn, args.entities, args.rows)
+            print(f"Format: {copy_format}")
+            for table in TABLE_TRANSFERS:
+                with long_conn:
+                    result = transfer_table(table, short_conn, long_conn, copy_format)
+                print_transfer(table, result)
+                results[(copy_format, table)] = result
+            short_conn.close()
+            long_conn.close()
+            sequential_seconds = sum(results[(copy_format, table)]["seconds"]
+                                     for table in TABLE_TRANSFERS)
+            drop_database(args.dsn, long_db)
+            create_database(args.dsn, long_db, LONG_TERM_SCHEMA)
+            start = time.perf_counter()
+            migrate_tables(lambda long_term: psycopg2.connect(
+                make_dsn(args.dsn, dbname=long_db if long_term else short_db)),
+                copy_format=copy_format)
+            parallel_seconds = time.perf_counter() - start
+            print(f"Sequential: {sequential_seconds:.2f}s, parallel: {parallel_seconds:.2f}s")
+            results[(copy_format, "parallel")] = {"sequential_seconds": sequential_seconds,
+                                                  "parallel_seconds": parallel_seconds}
+        finally:
+            drop_database(args.dsn, short_db)
+            drop_database(args.dsn, long_db)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dsn", default=os.getenv("BENCHMARK_DSN", "dbname=postgres"),
+                        help="Connection string for a Postgres server the benchmark may create databases on")
+    parser.add_argument("--entities", type=int, default=1000,
+                        help="Tracks and artists to create")
+    parser.add_argument("--rows", type=int, default=500000,
+                        help="Rows to create in each popularity and views table")
+    parser.add_argument("--formats", nargs="+", choices=["binary", "csv"],
+                        default=["binary", "csv"])
+    main(parser.parse_args())
@@ -5,7 +5,7 @@ import plotly.express as px
 import pandas as pd
 from datetime import timedelta, datetime
 
-from helper_functions import get_db_connection, conn, long_conn
+from helper_functions import get_db_connection, conn, long_conn, rebuild_hourly_series
 from pandas import DataFrame
 
 register_page(__name__, path="/artist_tiktok_metrics")
@@ -54,6 +54,8 @@ def get_artist_spotify_pop(long_term_conn, name: str = None) -> DataFrame:
     pd.to_datetime(artist_dates["created_at"])
     min_date = artist_dates["created_at"].dt.date.min()
     max_date = artist_dates["created_at"].dt.date.max() + timedelta(days=1)
+    artist_pop_df = rebuild_hourly_series(artist_pop_df)
+    artist_names = artist_pop_df["spotify_name"]
     return artist_pop_df, artist_names, min_date, max_date
 
 
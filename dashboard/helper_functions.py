@@ -19,6 +19,12 @@ tempo = 'the overall estimated tempo (i.e. speed/pace) of a track, with 0.0 bein
 speechiness = 'measure the proportion of the track that is filled with spoken word, with 0.66-1.0 being tracks that \
     are almost all spoken word, 0.33-0.66 being tracks that are a mixture of speech and music, and below 0.33 being \
         tracks with almost no speech.'
+# Popularity rows are only written when a value changes, and the daily move to the long
+# term database forces a fresh row. An entity that rarely changes is only polled every
+# MAX_POLL_INTERVAL_HOURS (the longest interval in extract/hourly_lambda/poll_schedule.py),
+# so its first row after the move can come up to that long after a day has passed
+MAX_POLL_INTERVAL_HOURS = 6
+MAX_CARRY_HOURS = 24 + MAX_POLL_INTERVAL_HOURS
 
 def get_db_connection(long_term: bool=False):
     '''
@@ -72,6 +78,19 @@ def get_top_ten(chart_type: str, conn) -> list[dict]:
 
     return top_entries
 
+def rebuild_hourly_series(df: pd.DataFrame, time_column: str = "time") -> pd.DataFrame:
+    '''
+    Takes a dataframe of change-only popularity rows for one entity and returns a
+    regular hourly series, carrying each value forward until the next change
+    '''
+    if df.empty:
+        return df
+    df = df.copy()
+    df[time_column] = pd.to_datetime(df[time_column])
+    hourly = df.set_index(time_column).sort_index().resample("h").last()
+    hourly = hourly.ffill(limit=MAX_CARRY_HOURS).dropna(how="all")
+    return hourly.reset_index()
+
 load_dotenv()
 conn = get_db_connection()
 long_conn = get_db_connection(True)
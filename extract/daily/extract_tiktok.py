@@ -1,33 +1,89 @@
 '''Helper functions to scrape tiktok charts webpage'''
-from bs4 import BeautifulSoup
-from rapidfuzz import fuzz
+from bs4 import BeautifulSoup, SoupStrainer, Tag
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import soupsieve
+from rapidfuzz import fuzz, process
+import numpy as np
+import re
 import string
 from urllib.request import urlopen, Request
+from datetime import date, timedelta
+from psycopg2.extras import RealDictCursor, Json, execute_values
 
-from requests import post, get
-import json
-import base64
+from spotify_client import get_spotify_client
 
 
 TIKTOK_BASE_URL = "https://ads.tiktok.com/business/creativecenter/inspiration/popular/music/pad/en"
 TIKTOK_COOKIE = {"name": "cookie-consent", "value": "{%22ga%22:true%2C%22af%22:true%2C%22fbp%22:true%2C%22lip%22:true%2C%22bing%22:true%2C%22ttads%22:true%2C%22reddit%22:true%2C%22criteo%22:true%2C%22version%22:%22v9%22}"}
 ARBITRARY_LIST = [{"name":"Funny son"}, {"name":"Crack Rock"}, {"name":"gobbledeegook"}, {"name":"ghost"}]
-SPOTIFY_BASE_URL = "http://api.spotify.com/v1/"
-TOKCHARTS_BASE_URL = "https://tokchart.com/?page="
+SPOTIFY_BASE_URL = os.getenv("SPOTIFY_BASE_URL", "https://api.spotify.com/v1/")
+TOKCHARTS_BASE_URL = os.getenv("TOKCHARTS_BASE_URL", "https://tokchart.com/?page=")
+TOKCHART_PAGES = range(1, 12)
+TOKCHART_MAX_CONNECTIONS = 4
+TOKCHART_TIMEOUT = 20
+TOKCHART_ROW_CLASS = "lg:flex sm:flex-col justify-between"
+TOKCHART_RANK_CLASSES = ["font-bold sm:font-extrabold text-lg sm:text-2xl",
+                         "font-bold sm:font-extrabold leading-7 text-base sm:text-xl"]
+TOKCHART_ARTIST_CLASSES = ["mt-1 sm:mt-2 text-sm text-gray-500 sm:block sm:text-xl",
+                           "mt-1 sm:mt-2 text-sm text-gray-500 sm:block sm:text-lg"]
+MATCH_THRESHOLD = 80
+SEARCH_ERROR = "error"
+NEGATIVE_RESOLUTION_DAYS = 7
+# (name, with_artist, general_search) in priority order
+SEARCH_STRATEGIES = [("with_artist", True, False),
+                     ("general", True, True),
+                     ("name_only", False, False)]
+SPECULATIVE_SEARCH = os.getenv("SPOTIFY_SPECULATIVE_SEARCH", "true").lower() == "true"
+HIGH_CONFIDENCE_SCORE = 90
+TITLE_SCORE_WEIGHT = 0.7
+FEATURE_PATTERN = re.compile(
+    r"\s*(?:[\(\[]\s*(?:feat|ft|featuring|with)\b[^\)\]]*[\)\]]|\s(?:feat|ft|featuring)\.?\s.*$)",
+    re.IGNORECASE)
+BRACKETED_VERSION_PATTERN = re.compile(
+    r"\s*[\(\[][^\)\]]*\b(?:remix|mix|edit|version|remaster(?:ed)?|sped up|slowed)\b[^\)\]]*[\)\]]",
+    re.IGNORECASE)
+DASHED_VERSION_PATTERN = re.compile(
+    r"\s+-\s+[^-]*\b(?:remix|mix|edit|version|remaster(?:ed)?|sped up|slowed)\b.*$",
+    re.IGNORECASE)
+PUNCTUATION_TABLE = str.maketrans(string.punctuation, " " * len(string.punctuation))
+
+
+def compile_class_selectors(class_names: list[str]) -> list:
+    '''
+    Compiles a list of exact class attribute selectors, tried in order as fallbacks
+    '''
+    return [soupsieve.compile(f'[class="{class_name}"]') for class_name in class_names]
+
+
+TOKCHART_RANK_SELECTORS = compile_class_selectors(TOKCHART_RANK_CLASSES)
+TOKCHART_ARTIST_SELECTORS = compile_class_selectors(TOKCHART_ARTIST_CLASSES)
+TOKCHART_ROW_STRAINER = SoupStrainer("div", {"class": TOKCHART_ROW_CLASS})
+
+
+def select_first_text(song: Tag, selectors: list):
+    '''
+    Returns the first text node of the first selector that matches, or None
+    '''
+    for selector in selectors:
+        element = selector.select_one(song)
+        if element is not None and len(element.contents) > 0:
+            return element.contents[0]
+    return None
 
 
 def load_tok_chart_soup(page_num: int, tokchart_url: str = TOKCHARTS_BASE_URL) -> list[BeautifulSoup]:
     '''
-    Loads and reads a tokchart page into a BeautifulSoup object
+    Loads a tokchart page and parses only its chart rows into a BeautifulSoup object
     '''
     try:
         req = Request(url=f"{tokchart_url}{str(page_num)}", headers={'User-Agent': 'Mozilla/5.0'})
     except:
         return None
-    with urlopen(req) as page:
+    with urlopen(req, timeout=TOKCHART_TIMEOUT) as page:
         html_bytes = page.read()
-        html = html_bytes.decode("utf-8")
-        soup = BeautifulSoup(html, "html.parser")
+        soup = BeautifulSoup(html_bytes, "lxml", parse_only=TOKCHART_ROW_STRAINER,
+                             from_encoding="utf-8")
         return soup
 
 
@@ -35,28 +91,22 @@ def get_tokchart_relevant_div(tok_soup: BeautifulSoup) -> list[dict]:
     '''
     Navigates through the tokchart soup and returns relevant track information
     '''
-    soup_div = tok_soup.find_all("div",{"class":"lg:flex sm:flex-col justify-between"})
+    soup_div = tok_soup.find_all("div", {"class": TOKCHART_ROW_CLASS})
     song_data = []
     for song in soup_div:
         song_info = {}
         song_name = song.find("h4").find("a").contents[0].strip()
         if "original sound" in song_name:
             continue
-        ## This try and except block is here because sometimes the formatting of the css is different
-        ## and so the identifier also changes
-        try:
-            song_rank = song.find("div", {"class": "font-bold sm:font-extrabold text-lg sm:text-2xl"}).contents[0].strip()
-        except:
-            try:
-                song_rank = song.find("div", {"class": "font-bold sm:font-extrabold leading-7 text-base sm:text-xl"}).contents[0].strip()
-            except:
-                continue
-        try:
-            song_artists = song.find("span", {"class": "mt-1 sm:mt-2 text-sm text-gray-500 sm:block sm:text-xl"}).contents[0]
-        except:
-            song_artists = song.find("span", {"class": "mt-1 sm:mt-2 text-sm text-gray-500 sm:block sm:text-lg"}).contents[0]
+        ## The css classes differ between rows, so each field has fallback selectors
+        song_rank = select_first_text(song, TOKCHART_RANK_SELECTORS)
+        if song_rank is None:
+            continue
+        song_artists = select_first_text(song, TOKCHART_ARTIST_SELECTORS)
+        if song_artists is None:
+            continue
         song_info["name"] = song_name.replace("#", "").strip()
-        song_info["tiktok_rank"] = song_rank
+        song_info["tiktok_rank"] = song_rank.strip()
         song_info["spotify_rank"] = None
         song_info["check_artists"] = [artist.strip() for artist in song_artists.split("&")]
         song_info["in_tiktok"] = True
@@ -65,41 +115,94 @@ def get_tokchart_relevant_div(tok_soup: BeautifulSoup) -> list[dict]:
     return song_data
 
 
+def get_tok_chart_page(page_num: int, base_url: str = TOKCHARTS_BASE_URL) -> list[dict]:
+    '''
+    Loads a single tokchart page and returns its track information, or an empty
+    list if the page couldn't be fetched or parsed
+    '''
+    try:
+        soup = load_tok_chart_soup(page_num, base_url)
+        if soup is None:
+            return []
+        return get_tokchart_relevant_div(soup)
+    except:
+        print(f"Error fetching data from {base_url}{page_num}")
+        return []
+
+
 def search_multiple_tok_pages(base_url: str = TOKCHARTS_BASE_URL) -> list[dict]:
     '''
-    Goes through multiple tokchart pages and returns all relevant track information
+    Fetches multiple tokchart pages concurrently and returns all relevant track
+    information in page order
     '''
     tracks = []
-    for i in range(1,12):
-        try:
-            soup = load_tok_chart_soup(i, base_url)
-            if soup is None:
-                continue
-            track_info = get_tokchart_relevant_div(soup)
-            [tracks.append(track) for track in track_info]
-        except:
-            print(f"Error fetching data from {base_url}{i}")
+    with ThreadPoolExecutor(max_workers=TOKCHART_MAX_CONNECTIONS) as executor:
+        pages = executor.map(lambda page_num: get_tok_chart_page(page_num, base_url),
+                             TOKCHART_PAGES)
+        for track_info in pages:
+            tracks.extend(track_info)
     return tracks
 
 
+def normalise_title(title: str) -> str:
+    '''
+    Lowercases a track title and strips punctuation, featured artists and remix
+    suffixes so that the same song scores the same on both charts
+    '''
+    stripped_title = FEATURE_PATTERN.sub("", title)
+    stripped_title = BRACKETED_VERSION_PATTERN.sub("", stripped_title)
+    stripped_title = DASHED_VERSION_PATTERN.sub("", stripped_title)
+    stripped_title = " ".join(stripped_title.lower().translate(PUNCTUATION_TABLE).split())
+    if stripped_title == "":
+        return title.lower().strip()
+    return stripped_title
+
+
+def normalise_artist(artist_name: str) -> str:
+    '''
+    Lowercases an artist name and strips its punctuation and extra whitespace
+    '''
+    return " ".join(artist_name.lower().translate(PUNCTUATION_TABLE).split())
+
+
 def match_tiktok_to_spotify(tiktok_tracks: list[dict], spotify_tracks: list[dict]) -> list[dict]:
     '''
-    Matches songs on tiktok and spotify top charts and 
+    Matches songs on tiktok and spotify top charts and
     return unmatched tiktok songs
     '''
+    if len(tiktok_tracks) == 0 or len(spotify_tracks) == 0:
+        return [track for track in tiktok_tracks if track["in_spotify"] is False]
+    tiktok_titles = [normalise_title(track["name"]) for track in tiktok_tracks]
+    spotify_titles = [normalise_title(track["name"]) for track in spotify_tracks]
+    scores = process.cdist(tiktok_titles, spotify_titles, scorer=fuzz.ratio,
+                           score_cutoff=MATCH_THRESHOLD, workers=-1)
+    spotify_tracks_by_artist = {}
+    for index, spotify_track in enumerate(spotify_tracks):
+        for artist in spotify_track.get("artists", []):
+            spotify_tracks_by_artist.setdefault(
+                normalise_artist(artist["name"]), set()).add(index)
+
     tiktok_not_on_spotify_chart = []
-    for tiktok_track in tiktok_tracks:
-        for spotify_track in spotify_tracks:
-            if tiktok_track["name"] == spotify_track["name"] or \
-                (fuzz.ratio(tiktok_track["name"].lower(), spotify_track["name"].lower())) > 80:
-                tiktok_track["in_spotify"] = True
-                spotify_track["in_tiktok"] = True
-                spotify_track["tiktok_rank"] = tiktok_track["tiktok_rank"]
-                break
+    for row, tiktok_track in enumerate(tiktok_tracks):
+        candidates = [int(index) for index in np.flatnonzero(scores[row] > MATCH_THRESHOLD)]
+        # Spotify tracks sharing an artist with the tiktok song are preferred and,
+        # among those, the closest title wins, then the highest chart position
+        shared_artist = set()
+        for artist in tiktok_track.get("check_artists", []):
+            shared_artist |= spotify_tracks_by_artist.get(normalise_artist(artist), set())
+        blocked = [index for index in candidates if index in shared_artist]
+        if len(blocked) > 0:
+            candidates = blocked
+        if len(candidates) > 0:
+            best = max(candidates, key=lambda index: (scores[row][index], -index))
+            spotify_track = spotify_tracks[best]
+            tiktok_track["in_spotify"] = True
+            spotify_track["in_tiktok"] = True
+            spotify_track["tiktok_rank"] = tiktok_track["tiktok_rank"]
         if tiktok_track["in_spotify"] is False:
             tiktok_not_on_spotify_chart.append(tiktok_track)
     return tiktok_not_on_spotify_chart
-    
+
 
 def general_api_url_search(track_name: str, artist_names: list[str]) -> str:
     '''
@@ -107,98 +210,222 @@ def general_api_url_search(track_name: str, artist_names: list[str]) -> str:
     '''
     for i in track_name:
         if i in string.punctuation:
-            track_name = track_name.split(i)
+            track_name = track_name.split(i)[0]
             break
-    return f"{SPOTIFY_BASE_URL}search/?q=track:{track_name[0]} artist:{artist_names[0]}&type=track&limit=1"
+    return f"{SPOTIFY_BASE_URL}search/?q=track:{track_name} artist:{artist_names[0]}&type=track&limit=1"
 
 
-def search_api_track(track_name: str, artist_names: list[str], with_artist: bool, general_search: bool, headers):
+def get_search_url(track_name: str, artist_names: list[str], with_artist: bool, general_search: bool) -> str:
     '''
-    Searches the spotify API using a tiktok song name and artists' names
+    Returns the search query url for a tiktok song name and artists' names
     '''
     if with_artist and general_search:
-        query_url = general_api_url_search(track_name, artist_names)
+        return general_api_url_search(track_name, artist_names)
     elif with_artist:
-        query_url = f"{SPOTIFY_BASE_URL}search/?q=track:{track_name} artist:{','.join(artist_names)}&type=track&limit=1"
-    else:
-        query_url = f"{SPOTIFY_BASE_URL}search/?q=track:{track_name}&type=track&limit=1"
-    print(query_url)
-    result = get(query_url, headers=headers)
+        return f"{SPOTIFY_BASE_URL}search/?q=track:{track_name} artist:{','.join(artist_names)}&type=track&limit=1"
+    return f"{SPOTIFY_BASE_URL}search/?q=track:{track_name}&type=track&limit=1"
+
+
+def get_search_items(result: dict):
+    '''
+    Returns the track items from a search response, or the response itself if it has none
+    '''
     try:
-        json_result = json.loads(result.content)["tracks"]["items"]
+        return result["tracks"]["items"]
     except:
-        json_result = json.loads(result.content)
-    return json_result
+        return result
+
+
+def search_api_track(track_name: str, artist_names: list[str], with_artist: bool, general_search: bool, headers):
+    '''
+    Searches the spotify API using a tiktok song name and artists' names
+    '''
+    query_url = get_search_url(track_name, artist_names, with_artist, general_search)
+    print(query_url)
+    return get_search_items(get_spotify_client().get(query_url, headers))
+
+
+def score_search_result(song_name: str, song_artist: list[str], track: dict) -> float:
+    '''
+    Scores how closely a search result matches a tiktok song's title and artists
+    '''
+    title_score = fuzz.ratio(normalise_title(song_name), normalise_title(track["name"]))
+    if len(song_artist) == 0:
+        return title_score
+    artist_score = max([fuzz.token_set_ratio(normalise_artist(tiktok_artist),
+                                             normalise_artist(artist["name"]))
+                        for tiktok_artist in song_artist
+                        for artist in track["artists"]], default=0)
+    return TITLE_SCORE_WEIGHT * title_score + (1 - TITLE_SCORE_WEIGHT) * artist_score
 
 
-def attempt_multiple_searches(song_name: str, song_artist: list[str], headers) -> list[dict]:
+def speculative_search(song_name: str, song_artist: list[str], headers) -> tuple:
+    '''
+    Fires every search strategy for a tiktok song at once and returns the best result
+    by fuzzy score, then strategy priority, in the same form as attempt_multiple_searches.
+    Outstanding searches are cancelled as soon as a high-confidence result arrives
+    '''
+    client = get_spotify_client()
+    strategies = SEARCH_STRATEGIES if len(song_artist) > 0 else SEARCH_STRATEGIES[-1:]
+    futures = {client.submit(get_search_url(song_name, song_artist, with_artist, general_search),
+                             headers): (priority, name)
+               for priority, (name, with_artist, general_search) in enumerate(strategies)}
+    candidates = []
+    errors = 0
+    for future in as_completed(futures):
+        priority, name = futures[future]
+        try:
+            items = get_search_items(future.result())
+        except Exception as err:
+            print(f"Search '{name}' failed for: {song_name} with error: {err.args}")
+            errors += 1
+            continue
+        if isinstance(items, dict) or (len(items) > 0 and "error" in items[0].keys()):
+            errors += 1
+            continue
+        if len(items) == 0:
+            continue
+        score = score_search_result(song_name, song_artist, items[0])
+        candidates.append((score, -priority, name, items))
+        if score >= HIGH_CONFIDENCE_SCORE:
+            for outstanding in futures:
+                outstanding.cancel()
+            break
+    if len(candidates) == 0:
+        if errors == len(strategies):
+            print(f"Cannot find song: {song_name} with artists: {','.join(song_artist)}")
+            return None, SEARCH_ERROR
+        print(f"Cannot find information for track: {song_name}")
+        return None, None
+    _, _, name, items = max(candidates, key=lambda candidate: candidate[:2])
+    return items, name
+
+
+def attempt_multiple_searches(song_name: str, song_artist: list[str], headers) -> tuple:
     '''
     Will search the spotify API multiple times with different query urls
-    depending on whether or not it receives a result initially
+    depending on whether or not it receives a result initially. Returns the
+    tracks found and the strategy that found them, (None, None) if nothing
+    was found, or (None, SEARCH_ERROR) if the API returned an error
     '''
     track = search_api_track(song_name, song_artist, True, False, headers)
+    strategy = "with_artist"
     if len(track) == 0:
         print(f"Error obtaining track information for: {song_name}")
         print("Attempting to find song in more general terms")
         track = search_api_track(song_name, song_artist, True, True, headers)
+        strategy = "general"
     if len(track) == 0:
         print(f"Error obtaining track information for: {song_name} in more general terms")
         print("Attempting to find song exclusively through song name")
         track = search_api_track(song_name, song_artist, False, False,headers)
+        strategy = "name_only"
     if len(track) == 0:
         print(f"Cannot find information for track: {song_name}")
-        return None
+        return None, None
     if isinstance(track, dict):
         if "error" in track.keys():
             print(f"Cannot find song: {song_name} with artists: {','.join(song_artist)}")
-        return None
+        return None, SEARCH_ERROR
     if "error" in track[0].keys():
         print(f"Cannot find song: {song_name} with artists: {','.join(song_artist)}")
-        return None
-    return track
+        return None, SEARCH_ERROR
+    return track, strategy
 
 
-def get_auth_token(client_id, client_secret) -> str:
+def get_resolution_key(song: dict) -> tuple:
     '''
-    Gets an authorisation token from Spotify API
+    Returns the normalised (title, first artist) key a tiktok song is resolved under
     '''
-    auth_string = f"{client_id}:{client_secret}"
-    auth_bytes = auth_string.encode("utf-8")
-    auth_base64 = str(base64.b64encode(auth_bytes), "utf-8")
+    if len(song["check_artists"]) > 0:
+        first_artist = normalise_artist(song["check_artists"][0])
+    else:
+        first_artist = ""
+    return normalise_title(song["name"]), first_artist
 
-    url = "https://accounts.spotify.com/api/token"
-    headers = {
-        "Authorization": "Basic " + auth_base64,
-        "Content-Type": "application/x-www-form-urlencoded"
-    }
-    data = {"grant_type": "client_credentials"}
-    result = post(url, headers=headers, data=data, timeout=10)
-    json_result = json.loads(result.content)
-    return json_result["access_token"]
 
+def get_cached_resolutions(conn, keys: list[tuple]) -> dict:
+    '''
+    Takes a list of resolution keys and returns the stored resolutions keyed by them.
+    Negative entries are only returned while their retry date hasn't passed
+    '''
+    if conn is None or len(keys) == 0:
+        return {}
+    sql_query = "SELECT r.normalised_title, r.normalised_artist, r.track_spotify_id, \
+        r.track_artists, r.search_strategy \
+        FROM tiktok_track_resolution AS r \
+        JOIN (VALUES %s) AS k (normalised_title, normalised_artist) \
+        ON r.normalised_title = k.normalised_title AND r.normalised_artist = k.normalised_artist \
+        WHERE r.track_spotify_id IS NOT NULL OR r.retry_after > current_date"
+    with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        rows = execute_values(cur, sql_query, list(dict.fromkeys(keys)),
+                              page_size=len(keys), fetch=True)
+    return {(row["normalised_title"], row["normalised_artist"]): row for row in rows}
 
-def get_auth_header(token: str) -> dict:
+
+def store_resolutions(conn, resolutions: dict) -> None:
     '''
-    Takes in authorisation token and returns header for API calls
+    Takes a dict of search results keyed by resolution key and stores them,
+    negative-caching songs that couldn't be found until their retry date
     '''
-    return {"Authorization": "Bearer " + token}
+    if conn is None or len(resolutions) == 0:
+        return None
+    sql_query = "INSERT INTO tiktok_track_resolution (normalised_title, normalised_artist, \
+        track_spotify_id, track_artists, search_strategy, retry_after) VALUES %s \
+        ON CONFLICT (normalised_title, normalised_artist) DO UPDATE \
+        SET track_spotify_id = EXCLUDED.track_spotify_id, track_artists = EXCLUDED.track_artists, \
+        search_strategy = EXCLUDED.search_strategy, retry_after = EXCLUDED.retry_after, \
+        resolved_at = current_timestamp"
+    vals = []
+    for (title, artist), (track, strategy) in resolutions.items():
+        if track is None:
+            vals.append((title, artist, None, None, None,
+                         date.today() + timedelta(days=NEGATIVE_RESOLUTION_DAYS)))
+        else:
+            artists = [{"id": artist["id"], "name": artist["name"]}
+                       for artist in track[0]["artists"]]
+            vals.append((title, artist, track[0]["id"], Json(artists), strategy, None))
+    with conn, conn.cursor() as cur:
+        execute_values(cur, sql_query, vals, page_size=len(vals))
+    return None
 
 
-def get_tiktok_tracks_api_info(songs: list[dict], headers: dict) -> list[dict]:
+def get_tiktok_tracks_api_info(songs: list[dict], headers: dict, conn=None) -> list[dict]:
     '''
     Iterates through a list of unmatched tiktok songs and finds the track
-    information on the spotify API
+    information, checking stored resolutions before searching the spotify API
     '''
-    for song in songs:
-        track = attempt_multiple_searches(song["name"], song["check_artists"], headers)
-        if track is None:
-            continue
+    keys = [get_resolution_key(song) for song in songs]
+    cached = get_cached_resolutions(conn, keys)
+    unresolved = list(dict.fromkeys(key for key in keys if key not in cached))
+    unresolved_songs = {key: song for key, song in zip(keys, songs) if key in unresolved}
+    search = speculative_search if SPECULATIVE_SEARCH else attempt_multiple_searches
+    results = get_spotify_client().map_concurrently(
+        lambda key: search(unresolved_songs[key]["name"],
+                           unresolved_songs[key]["check_artists"], headers),
+        unresolved)
+    searched = {key: result for key, result in zip(unresolved, results)
+                if result[1] != SEARCH_ERROR}
+    store_resolutions(conn, searched)
+    print(f"Resolved {len([key for key in keys if key in cached])} tiktok songs from storage, "
+          f"searched for {len(unresolved)}")
+
+    for song, key in zip(songs, keys):
+        if key in cached:
+            if cached[key]["track_spotify_id"] is None:
+                continue
+            track_id = cached[key]["track_spotify_id"]
+            artists = cached[key]["track_artists"]
+        elif key in searched and searched[key][0] is not None:
+            track_id = searched[key][0][0]["id"]
+            artists = searched[key][0][0]["artists"]
         else:
-            song["id"] = track[0]["id"]
-            song["artists"] = []
-            for artist in track[0]["artists"]:
-                track_artist = {}
-                track_artist["name"] = artist["name"]
-                track_artist["id"] = artist["id"]
-                song["artists"].append(track_artist)
+            continue
+        song["id"] = track_id
+        song["artists"] = []
+        for artist in artists:
+            track_artist = {}
+            track_artist["name"] = artist["name"]
+            track_artist["id"] = artist["id"]
+            song["artists"].append(track_artist)
     return songs
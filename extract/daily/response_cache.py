@@ -0,0 +1,110 @@
+'''Read-through cache of Spotify API responses shared by the daily and hourly lambdas'''
+from datetime import timedelta
+from psycopg2.extras import RealDictCursor, Json, execute_values
+
+
+# How old a cached response may be for each kind of data read from it.
+# None means the response never goes stale.
+ENTITY_TTLS = {
+    "audio_features": None,
+    "genres": timedelta(days=1),
+    "popularity": timedelta(minutes=50)
+}
+# Rows are evicted once they are too old for every entity read from their endpoint
+ENDPOINT_TTLS = {
+    "audio-features": None,
+    "artists": timedelta(days=1),
+    "tracks": timedelta(minutes=50)
+}
+CACHE_STATS = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def get_cached_responses(conn, endpoint: str, ids: list[str], entity: str) -> dict:
+    '''
+    Takes an endpoint and list of ids and returns the cached responses that are still
+    fresh enough for the given entity type, keyed by id
+    '''
+    if conn is None or len(ids) == 0:
+        CACHE_STATS["misses"] += len(ids)
+        return {}
+    ttl = ENTITY_TTLS[entity]
+    sql_query = "SELECT entity_id, response FROM spotify_response_cache \
+        WHERE endpoint = %s AND entity_id = ANY(%s)"
+    vals = [endpoint, list(ids)]
+    if ttl is not None:
+        sql_query += " AND fetched_at > current_timestamp - %s"
+        vals.append(ttl)
+    with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(sql_query, vals)
+        responses = {row["entity_id"]: row["response"] for row in cur.fetchall()}
+    CACHE_STATS["hits"] += len(responses)
+    CACHE_STATS["misses"] += len(ids) - len(responses)
+    return responses
+
+
+def store_responses(conn, endpoint: str, responses: dict) -> None:
+    '''
+    Takes an endpoint and a dict of responses keyed by id and upserts them into the cache
+    '''
+    if conn is None or len(responses) == 0:
+        return None
+    sql_query = "INSERT INTO spotify_response_cache (endpoint, entity_id, response) VALUES %s \
+        ON CONFLICT (endpoint, entity_id) DO UPDATE \
+        SET response = EXCLUDED.response, fetched_at = current_timestamp"
+    vals = [(endpoint, entity_id, Json(response))
+            for entity_id, response in responses.items()]
+    with conn, conn.cursor() as cur:
+        execute_values(cur, sql_query, vals)
+    return None
+
+
+def evict_expired_responses(conn) -> int:
+    '''
+    Deletes cached responses that are too old to be used by anything and returns
+    the number of rows removed
+    '''
+    if conn is None:
+        return 0
+    evicted = 0
+    with conn, conn.cursor() as cur:
+        for endpoint, ttl in ENDPOINT_TTLS.items():
+            if ttl is None:
+                continue
+            cur.execute("DELETE FROM spotify_response_cache \
+                WHERE endpoint = %s AND fetched_at <= current_timestamp - %s", (endpoint, ttl))
+            evicted += cur.rowcount
+    CACHE_STATS["evictions"] += evicted
+    return evicted
+
+
+def get_through_cache(conn, endpoint: str, ids: list[str], entity: str, fetch) -> dict:
+    '''
+    Returns responses for every id, reading from the cache first and calling
+    fetch(missing_ids) -> dict for the rest, which are then stored
+    '''
+    ids = list(dict.fromkeys(ids))
+    responses = get_cached_responses(conn, endpoint, ids, entity)
+    missing_ids = [entity_id for entity_id in ids if entity_id not in responses]
+    if len(missing_ids) > 0:
+        fetched = fetch(missing_ids)
+        store_responses(conn, endpoint, {entity_id: response
+                                         for entity_id, response in fetched.items()
+                                         if response is not None and "error" not in response})
+        responses.update(fetched)
+    return responses
+
+
+def reset_cache_stats() -> None:
+    '''
+    Zeroes the cache counters, which otherwise carry over between warm invocations
+    '''
+    for key in CACHE_STATS:
+        CACHE_STATS[key] = 0
+
+
+def print_cache_stats() -> None:
+    '''
+    Prints the cache hit, miss and eviction counters for this run
+    '''
+    print(f"Spotify cache: {CACHE_STATS['hits']} hits, {CACHE_STATS['misses']} misses, "
+          f"{CACHE_STATS['evictions']} evictions")
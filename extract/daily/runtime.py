@@ -0,0 +1,95 @@
+'''Spotify token and database connection kept alive across warm Lambda invocations'''
+import base64
+import json
+import os
+from datetime import datetime, timedelta
+import psycopg2
+from psycopg2.extensions import connection, TRANSACTION_STATUS_IDLE
+
+from spotify_client import get_spotify_client
+
+
+SPOTIFY_TOKEN_URL = os.getenv("SPOTIFY_TOKEN_URL", "https://accounts.spotify.com/api/token")
+TOKEN_EXPIRY_MARGIN = timedelta(seconds=60)
+RUNTIME = {"token": None, "token_expires_at": None, "conn": None, "long_term_conn": None}
+
+
+def get_auth_token(client_id: str, client_secret: str) -> str:
+    '''
+    Returns the cached Spotify authorisation token, requesting a new one
+    when it is missing or about to expire
+    '''
+    if RUNTIME["token"] is not None and \
+            datetime.now() < RUNTIME["token_expires_at"] - TOKEN_EXPIRY_MARGIN:
+        return RUNTIME["token"]
+    auth_string = f"{client_id}:{client_secret}"
+    auth_bytes = auth_string.encode("utf-8")
+    auth_base64 = str(base64.b64encode(auth_bytes), "utf-8")
+
+    headers = {
+        "Authorization": "Basic " + auth_base64,
+        "Content-Type": "application/x-www-form-urlencoded"
+    }
+    data = {"grant_type": "client_credentials"}
+    result = get_spotify_client().session.post(
+        SPOTIFY_TOKEN_URL, headers=headers, data=data, timeout=10)
+    json_result = json.loads(result.content)
+    RUNTIME["token"] = json_result["access_token"]
+    RUNTIME["token_expires_at"] = datetime.now() + \
+        timedelta(seconds=json_result["expires_in"])
+    return RUNTIME["token"]
+
+
+def get_auth_header(token: str) -> dict:
+    '''
+    Takes in authorisation token and returns header for API calls
+    '''
+    return {"Authorization": "Bearer " + token}
+
+
+def connection_is_alive(conn: connection) -> bool:
+    '''
+    Checks a connection can be reused, rolling back anything left open by a
+    previous invocation before a single round trip
+    '''
+    if conn is None or conn.closed:
+        return False
+    try:
+        if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def get_db_connection(long_term: bool = False) -> connection:
+    '''
+    Returns the cached database connection, reconnecting if it has been closed or dropped
+    '''
+    if long_term == True:
+        runtime_key = "long_term_conn"
+        db_name = "DB_LONG_TERM_NAME"
+        db_host = "DB_LONG_TERM_HOST"
+    else:
+        runtime_key = "conn"
+        db_name = "DB_NAME"
+        db_host = "DB_HOST"
+    if connection_is_alive(RUNTIME[runtime_key]):
+        return RUNTIME[runtime_key]
+    try:
+        conn = psycopg2.connect(
+            user=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASSWORD"),
+            host=os.getenv(db_host),
+            port=os.getenv("DB_PORT"),
+            database=os.getenv(db_name)
+        )
+        print("Connected")
+        RUNTIME[runtime_key] = conn
+        return conn
+    except Exception as e:
+        print(e)
+        print("Error connecting to database.")
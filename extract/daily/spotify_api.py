@@ -1,21 +1,20 @@
 """Daily Lambda"""
-import base64
-import json
 import os
 from dotenv import load_dotenv
-from requests import post, get
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 from datetime import datetime
 import operator
 
+from spotify_client import get_spotify_client
+from runtime import get_auth_token, get_auth_header, get_db_connection
+from response_cache import get_through_cache, evict_expired_responses, \
+    reset_cache_stats, print_cache_stats
 from extract_tiktok import match_tiktok_to_spotify, \
     get_tiktok_tracks_api_info, \
     search_multiple_tok_pages
 
 
 BUCKET_NAME = "c7-spotify-tiktok-output"
-SPOTIFY_BASE_URL = "http://api.spotify.com/v1/"
 TOP_50_PLAYLIST_ID = "37i9dQZEVXbMDoHDwVN2tF"
 TRACK_FILENAME = 'track_ids.csv'
 ARTIST_FILENAME = 'artist_ids.csv'
@@ -24,47 +23,26 @@ TIKTOK_COOKIE = {"name": "cookie-consent",
                  "value": "{%22ga%22:true%2C%22af%22:true%2C%22fbp%22:true%2C%22lip%22:true%2C%22bing%22:true%2C%22ttads%22:true%2C%22reddit%22:true%2C%22criteo%22:true%2C%22version%22:%22v9%22}"}
 AUDIO_FEATURE_KEYS = ["danceability", "energy",
                       "valence", "tempo", "speechiness"]
-TOKCHARTS_BASE_URL = "https://tokchart.com/?page="
-EVENT_KEYS = ["old_tracks", "old_artists"]
+AUDIO_FEATURES_BATCH_SIZE = 100
+ARTISTS_BATCH_SIZE = 50
+TRACK_NAME_MAX_LENGTH = 200
+ARTIST_NAME_MAX_LENGTH = 100
 
-
-def get_auth_token(client_id: str, client_secret: str) -> str:
-    '''
-    Gets an authorisation token from Spotify API
-    '''
-    auth_string = f"{client_id}:{client_secret}"
-    auth_bytes = auth_string.encode("utf-8")
-    auth_base64 = str(base64.b64encode(auth_bytes), "utf-8")
-
-    url = "https://accounts.spotify.com/api/token"
-    headers = {
-        "Authorization": "Basic " + auth_base64,
-        "Content-Type": "application/x-www-form-urlencoded"
-    }
-    data = {"grant_type": "client_credentials"}
-    result = post(url, headers=headers, data=data, timeout=10)
-    json_result = json.loads(result.content)
-    return json_result["access_token"]
-
-
-def get_auth_header(token: str) -> dict:
-    '''
-    Takes in authorisation token and returns header for API calls
-    '''
-    return {"Authorization": "Bearer " + token}
+SPOTIFY_BASE_URL = os.getenv("SPOTIFY_BASE_URL", "https://api.spotify.com/v1/")
+TOKCHARTS_BASE_URL = os.getenv("TOKCHARTS_BASE_URL", "https://tokchart.com/?page=")
+INCREMENTAL_EXTRACT = os.getenv("INCREMENTAL_EXTRACT", "true").lower() == "true"
 
 
 def get_spotify_top_50(top_50_uri: str, headers: dict) -> list[dict]:
     '''
     Takes playlist id and returns list of dictionaries of tracks in the playlist
     '''
-    result = get(f"{SPOTIFY_BASE_URL}playlists/{top_50_uri}/tracks",
-                 headers=headers, timeout=10)
-    result = json.loads(result.content)
+    result = get_spotify_client().get(
+        f"{SPOTIFY_BASE_URL}playlists/{top_50_uri}/tracks", headers)
     return result["items"]
 
 
-def create_track_dicts(items: list[dict], headers) -> list[dict]:
+def create_track_dicts(items: list[dict]) -> list[dict]:
     '''
     Takes in a list of playlist items and returns a list of dictionaries of each track
     '''
@@ -79,207 +57,265 @@ def create_track_dicts(items: list[dict], headers) -> list[dict]:
         track["tiktok_rank"] = None
         track["in_spotify"] = True
         track["in_tiktok"] = False
-        audio_features = get_track_audio_features(track["id"], headers)
-        track["danceability"] = audio_features["danceability"]
-        track["energy"] = audio_features["energy"]
-        track["valence"] = audio_features["valence"]
-        track["tempo"] = audio_features["tempo"]
-        track["speechiness"] = audio_features["speechiness"]
 
         track["artists"] = []
         for artist in item["track"]["artists"]:
             artist_dict = {}
             artist_dict["id"] = artist["id"]
             artist_dict["name"] = artist["name"]
-            artist_followers = get_artist_genres(artist["id"], headers)
-            artist_dict["genres"] = artist_followers["genres"]
             track["artists"].append(artist_dict)
         tracks.append(track)
     return tracks
 
 
-def get_artist_genres(artist_id: str, headers: dict) -> tuple:
+def chunk_ids(ids: list[str], size: int) -> list[list[str]]:
     '''
-    Takes an artist id and gets the popularity rating and follower count for that artist
+    Splits a list of ids into chunks no bigger than the given size
     '''
-    result = get(f"{SPOTIFY_BASE_URL}artists/{artist_id}",
-                 headers=headers, timeout=10)
-    result = json.loads(result.content)
-    artist_followers = {}
-    artist_followers["genres"] = result["genres"]
-    return artist_followers
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
 
 
-def get_track_audio_features(track_id: str, headers: dict) -> tuple:
-    '''
-    Takes a track id and gets danceability, energy, valence, tempo, and speechiness scores
+def get_several_objects(endpoint: str, result_key: str, ids: list[str], batch_size: int,
+                        headers: dict) -> dict:
     '''
-    result = get(f"{SPOTIFY_BASE_URL}audio-features/{track_id}",
-                 headers=headers, timeout=10)
-    result = json.loads(result.content)
-    audio_features = {}
-    audio_features["danceability"] = result["danceability"]
-    audio_features["energy"] = result["energy"]
-    audio_features["valence"] = result["valence"]
-    audio_features["tempo"] = result["tempo"]
-    audio_features["speechiness"] = result["speechiness"]
-    return audio_features
-
-
-def get_db_connection():
+    Takes a multi-id endpoint and a list of ids and returns the response objects keyed
+    by id. Ids that Spotify returns as null are left out
     '''
-    Connects to the database
+    objects = {}
+    urls = [f"{SPOTIFY_BASE_URL}{endpoint}?ids={','.join(chunk)}"
+            for chunk in chunk_ids(ids, batch_size)]
+    for result in get_spotify_client().get_many(urls, headers):
+        for item in result.get(result_key, []):
+            if item is None:
+                continue
+            objects[item["id"]] = item
+    return objects
+
+
+def get_several_artist_genres(artist_ids: list[str], headers: dict, conn=None) -> dict:
     '''
-    try:
-        conn = psycopg2.connect(
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD"),
-            host=os.getenv("DB_HOST"),
-            port=os.getenv("DB_PORT"),
-            database=os.getenv("DB_NAME")
-        )
-        print("Connected")
-        return conn
-    except Exception as e:
-        print(e)
-        print("Error connecting to database.")
-
-
-def add_track_data(data: list[dict], conn) -> None:
-    '''
-    Takes in data on tracks and inserts track details into the track table
+    Takes a list of artist ids and returns a dict of genres keyed by artist id,
+    reading through the response cache before using the multi-id artists endpoint
     '''
-    for track in data:
-        try:
-            with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
-                sql_input = "INSERT INTO track (track_name, track_danceability, track_energy, \
-                    track_valence, track_tempo, track_speechiness, in_spotify, in_tiktok, \
-                        tiktok_rank, spotify_rank, track_spotify_id)\
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING"
-                vals = [track["name"], track["danceability"], track["energy"], track["valence"],
-                        track["tempo"], track["speechiness"], track["in_spotify"],
-                        track["in_tiktok"], track["tiktok_rank"],
-                        track["spotify_rank"], track["id"]]
-                cur.execute(sql_input, vals)
-                conn.commit()
-        except Exception as err:
-            print(f"Error for song '{track['name']}' when trying to insert into database\
-                  with error: {err.args}")
+    artists = get_through_cache(conn, "artists", artist_ids, "genres",
+                                lambda missing_ids: get_several_objects(
+                                    "artists", "artists", missing_ids,
+                                    ARTISTS_BATCH_SIZE, headers))
+    return {artist_id: artist["genres"] for artist_id, artist in artists.items()}
 
 
-def add_artist_data(data: list, conn) -> None:
+def get_several_audio_features(track_ids: list[str], headers: dict, conn=None) -> dict:
     '''
-    Takes in data on tracks and inserts artist details into the artist table
+    Takes a list of track ids and returns a dict of danceability, energy, valence,
+    tempo, and speechiness scores keyed by track id, reading through the response
+    cache before using the multi-id audio-features endpoint
     '''
-    for track in data:
-        try:
-            for artist in track["artists"]:
-                with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    sql_input = "INSERT INTO artist (spotify_name, artist_spotify_id)\
-                        VALUES (%s, %s) ON CONFLICT DO NOTHING"
-                    vals = [artist["name"], artist["id"]]
-                    cur.execute(sql_input, vals)
-                    conn.commit()
-
-                for genre in artist["genres"]:
-                    genre_id = add_genre(genre, conn)
-                    add_artist_genre(genre_id, artist["id"], conn)
-                add_track_artist(track["id"], artist["id"], conn)
-        except Exception as err:
-            print(f"Error for artists in '{track['name']}' when trying to insert into database\
-                  with error: {err.args}")
+    results = get_through_cache(conn, "audio-features", track_ids, "audio_features",
+                                lambda missing_ids: get_several_objects(
+                                    "audio-features", "audio_features", missing_ids,
+                                    AUDIO_FEATURES_BATCH_SIZE, headers))
+    return {track_id: {key: features[key] for key in AUDIO_FEATURE_KEYS}
+            for track_id, features in results.items()}
 
 
-def add_genre(genre_name: str, conn) -> int:
+def get_known_attributes(long_conn, track_ids: list[str], artist_ids: list[str]) -> tuple:
     '''
-    Takes in a genre name, adds to the database if not there, and returns genre id
+    Looks up tracks and artists that have charted before in the long term database
+    and returns their audio features and genres keyed by id
     '''
-    with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("INSERT INTO genre (genre_name) VALUES (%s) \
-                        ON CONFLICT DO NOTHING", (genre_name,))
-        conn.commit()
-        cur.execute(
-            "SELECT genre_id FROM genre WHERE genre_name = %s", (genre_name,))
-        genre_id = cur.fetchone()
-    return genre_id['genre_id']
+    known_features = {}
+    known_genres = {}
+    if long_conn is None or not INCREMENTAL_EXTRACT:
+        return known_features, known_genres
+    with long_conn, long_conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("SELECT track_spotify_id, track_danceability, track_energy, track_valence, \
+            track_tempo, track_speechiness FROM track WHERE track_spotify_id = ANY(%s)",
+                    (track_ids,))
+        for row in cur.fetchall():
+            known_features[row["track_spotify_id"]] = {key: row[f"track_{key}"]
+                                                       for key in AUDIO_FEATURE_KEYS}
+        cur.execute("SELECT artist_spotify_id, artist_genres FROM artist \
+            WHERE artist_spotify_id = ANY(%s)", (artist_ids,))
+        for row in cur.fetchall():
+            if row["artist_genres"] is None:
+                known_genres[row["artist_spotify_id"]] = []
+            else:
+                known_genres[row["artist_spotify_id"]] = row["artist_genres"].split(", ")
+    return known_features, known_genres
+
+
+def enrich_tracks(tracks: list[dict], headers: dict, conn=None, long_conn=None) -> list[dict]:
+    '''
+    Collects every track and artist id in a list of track dicts, copies the attributes
+    of ones already in the long term database, resolves the rest in batches and adds
+    audio features and genres to their respective dicts
+    '''
+    track_ids = []
+    artist_ids = []
+    for track in tracks:
+        if "id" not in track.keys():
+            continue
+        track_ids.append(track["id"])
+        artist_ids.extend([artist["id"] for artist in track["artists"]])
+    track_ids = list(dict.fromkeys(track_ids))
+    artist_ids = list(dict.fromkeys(artist_ids))
+
+    audio_features, artist_genres = get_known_attributes(long_conn, track_ids, artist_ids)
+    new_track_ids = [track_id for track_id in track_ids if track_id not in audio_features]
+    new_artist_ids = [artist_id for artist_id in artist_ids if artist_id not in artist_genres]
+    audio_features.update(get_several_audio_features(new_track_ids, headers, conn))
+    artist_genres.update(get_several_artist_genres(new_artist_ids, headers, conn))
+    print(f"Reused {len(track_ids) - len(new_track_ids)} tracks and "
+          f"{len(artist_ids) - len(new_artist_ids)} artists, fetched {len(new_track_ids)} "
+          f"tracks and {len(new_artist_ids)} artists")
+
+    for track in tracks:
+        if "id" not in track.keys():
+            print(
+                f"Track '{track['name']}'is missing id and cannot be used to find audio features")
+            continue
+        if track["id"] not in audio_features:
+            print(
+                f"Track '{track['name']}' is missing audio features and cannot be used")
+            continue
+        track.update(audio_features[track["id"]])
+        for artist in track["artists"]:
+            artist["genres"] = artist_genres.get(artist["id"], [])
+    return tracks
 
 
-def add_artist_genre(genre_id: int, artist_id: int, conn):
+def validate_tracks(data: list[dict]) -> list[dict]:
     '''
-    Takes in a genre id and artist id and adds them to the artist_genre table
+    Checks each track and its artists can be inserted and returns the ones that can,
+    printing an error for every track that is skipped
     '''
-    with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
-        sql_input = "INSERT INTO artist_genre (genre_id, artist_spotify_id)\
-                    VALUES (%s, %s) ON CONFLICT DO NOTHING"
-        vals = [genre_id, artist_id]
-        cur.execute(sql_input, vals)
-        conn.commit()
+    valid_tracks = []
+    for track in data:
+        missing_keys = [key for key in ["id", "name"] + AUDIO_FEATURE_KEYS
+                        if track.get(key) is None]
+        if "artists" not in track.keys():
+            missing_keys.append("artists")
+        if len(missing_keys) > 0:
+            print(f"Error for song '{track.get('name')}' when trying to insert into database\
+                  with error: missing {', '.join(missing_keys)}")
+            continue
+        if len(track["name"]) > TRACK_NAME_MAX_LENGTH:
+            print(f"Error for song '{track['name']}' when trying to insert into database\
+                  with error: name longer than {TRACK_NAME_MAX_LENGTH} characters")
+            continue
+        bad_artists = [artist.get("name") for artist in track["artists"]
+                       if artist.get("id") is None or artist.get("name") is None
+                       or len(artist["name"]) > ARTIST_NAME_MAX_LENGTH]
+        if len(bad_artists) > 0:
+            print(f"Error for artists in '{track['name']}' when trying to insert into database\
+                  with error: invalid artists {bad_artists}")
+            continue
+        valid_tracks.append(track)
+    return valid_tracks
 
 
-def add_track_artist(track_id: int, artist_id: int, conn):
+def load_spotify_data(data: list[dict], conn) -> None:
     '''
-    Takes in a track id and artist id and adds them to the track_artist table
+    Takes in data on tracks and loads the track, artist, genre, artist_genre and
+    track_artist tables with one statement per table in a single transaction
     '''
-    with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
-        sql_input = "INSERT INTO track_artist (track_spotify_id, artist_spotify_id)\
-                    VALUES (%s, %s) ON CONFLICT DO NOTHING"
-        vals = [track_id, artist_id]
-        cur.execute(sql_input, vals)
-        conn.commit()
+    tracks = {}
+    artists = {}
+    artist_genres = {}
+    track_artists = {}
+    for track in validate_tracks(data):
+        tracks.setdefault(track["id"], (track["name"], track["danceability"], track["energy"],
+                                        track["valence"], track["tempo"], track["speechiness"],
+                                        track["in_spotify"], track["in_tiktok"],
+                                        track["tiktok_rank"], track["spotify_rank"],
+                                        track["id"]))
+        for artist in track["artists"]:
+            artists.setdefault(artist["id"], (artist["name"], artist["id"]))
+            track_artists[(track["id"], artist["id"])] = None
+            for genre in artist.get("genres", []):
+                artist_genres[(genre, artist["id"])] = None
+    genre_names = list(dict.fromkeys(genre for genre, _ in artist_genres))
 
-
-def get_tiktok_attributes(unmatched_tiktok_songs: list[dict], headers: dict) -> list[dict]:
+    with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        sql_input = "INSERT INTO track (track_name, track_danceability, track_energy, \
+            track_valence, track_tempo, track_speechiness, in_spotify, in_tiktok, \
+                tiktok_rank, spotify_rank, track_spotify_id) VALUES %s ON CONFLICT DO NOTHING"
+        execute_values(cur, sql_input, list(tracks.values()),
+                       page_size=max(len(tracks), 1))
+
+        sql_input = "INSERT INTO artist (spotify_name, artist_spotify_id) VALUES %s \
+            ON CONFLICT DO NOTHING"
+        execute_values(cur, sql_input, list(artists.values()),
+                       page_size=max(len(artists), 1))
+
+        genre_ids = {}
+        if len(genre_names) > 0:
+            sql_input = "INSERT INTO genre (genre_name) VALUES %s \
+                ON CONFLICT (genre_name) DO UPDATE SET genre_name = EXCLUDED.genre_name \
+                RETURNING genre_id, genre_name"
+            rows = execute_values(cur, sql_input, [(genre,) for genre in genre_names],
+                                  page_size=len(genre_names), fetch=True)
+            genre_ids = {row["genre_name"]: row["genre_id"] for row in rows}
+
+        # Link rows are filtered through joins so an artist or track that was skipped
+        # on a unique name conflict doesn't abort the whole transaction
+        sql_input = "INSERT INTO artist_genre (genre_id, artist_spotify_id) \
+            SELECT v.genre_id, v.artist_spotify_id \
+            FROM (VALUES %s) AS v (genre_id, artist_spotify_id) \
+            JOIN artist ON artist.artist_spotify_id = v.artist_spotify_id \
+            WHERE NOT EXISTS (SELECT 1 FROM artist_genre AS ag \
+                WHERE ag.genre_id = v.genre_id AND ag.artist_spotify_id = v.artist_spotify_id)"
+        vals = [(genre_ids[genre], artist_id) for genre, artist_id in artist_genres]
+        execute_values(cur, sql_input, vals, page_size=max(len(vals), 1))
+
+        sql_input = "INSERT INTO track_artist (track_spotify_id, artist_spotify_id) \
+            SELECT v.track_spotify_id, v.artist_spotify_id \
+            FROM (VALUES %s) AS v (track_spotify_id, artist_spotify_id) \
+            JOIN track ON track.track_spotify_id = v.track_spotify_id \
+            JOIN artist ON artist.artist_spotify_id = v.artist_spotify_id \
+            WHERE NOT EXISTS (SELECT 1 FROM track_artist AS ta \
+                WHERE ta.track_spotify_id = v.track_spotify_id \
+                AND ta.artist_spotify_id = v.artist_spotify_id)"
+        vals = list(track_artists)
+        execute_values(cur, sql_input, vals, page_size=max(len(vals), 1))
+    print(f"Loaded {len(tracks)} tracks, {len(artists)} artists and {len(genre_names)} genres")
+
+
+def get_chart_history(long_conn) -> dict:
     '''
-    Searches the spotify API for tiktok songs' audio features and adds them to
-    their respective dict
+    Loads the ids of every track and artist that has ever charted from the
+    long term database into a set per entity type
     '''
-    for track in unmatched_tiktok_songs:
-        if "id" not in track.keys():
-            print(
-                f"Track '{track['name']}'is missing id and cannot be used to find audio features")
-        else:
-            audio_features = get_track_audio_features(track["id"], headers)
-            for key in AUDIO_FEATURE_KEYS:
-                if key not in audio_features.keys():
-                    print(
-                        f"Track '{track['name']}' is missing key: {key} and cannot be used")
-                    continue
-            track["danceability"] = audio_features["danceability"]
-            track["energy"] = audio_features["energy"]
-            track["valence"] = audio_features["valence"]
-            track["tempo"] = audio_features["tempo"]
-            track["speechiness"] = audio_features["speechiness"]
-            for artist in track["artists"]:
-                artist_followers = get_artist_genres(artist["id"], headers)
-                if "genres" not in artist_followers.keys():
-                    continue
-                else:
-                    artist["genres"] = artist_followers["genres"]
-    return unmatched_tiktok_songs
-
-
-def match_old_tracks_and_artists(old_tracks: dict, old_artists, new_tracks: list[dict]) -> list[dict]:
+    chart_history = {"track": set(), "artist": set()}
+    with long_conn, long_conn.cursor() as cur:
+        cur.execute("SELECT entity_type, spotify_id FROM chart_history;")
+        for entity_type, spotify_id in cur:
+            chart_history.setdefault(entity_type, set()).add(spotify_id)
+    return chart_history
+
+
+def find_new_to_chart(chart_history: dict, new_tracks: list[dict]) -> list[dict]:
     '''
-    Matches the previous days data with today's extracted data and returns
-    a list of tracks that weren't there yesterday
+    Returns the top 10 tiktok-ranked tracks that have never charted before,
+    flagging which of their artists are also charting for the first time
     '''
-    if old_tracks is None or old_artists is None:
-        return "Couldn't find old tracks and artists :("
+    if chart_history is None:
+        return None
     new_to_track_charts = []
     for new_track in new_tracks:
         if "id" not in new_track.keys() or "artists" not in new_track.keys():
             continue
-        track_counter = 0
-        for old_track in old_tracks:
-            if new_track["name"] == old_track[0]:
-                track_counter += 1
-        if track_counter == 0:
-            new_to_track_charts.append(
-                {"name": new_track['name'], "artists": new_track["artists"], "tiktok_rank": new_track["tiktok_rank"]})
-    new_tiktok_tracks = [
-        track for track in new_to_track_charts if track.get("tiktok_rank") != None]
+        if new_track.get("tiktok_rank") is None or new_track["id"] in chart_history["track"]:
+            continue
+        artists = [{"name": artist["name"], "id": artist["id"],
+                    "new_artist": artist["id"] not in chart_history["artist"]}
+                   for artist in new_track["artists"]]
+        new_to_track_charts.append({"name": new_track["name"], "artists": artists,
+                                    "tiktok_rank": new_track["tiktok_rank"],
+                                    "spotify_rank": new_track["spotify_rank"],
+                                    "first_appearance": True})
     new_tiktok_tracks = sorted(
-        new_tiktok_tracks, key=lambda x: x['tiktok_rank'])
+        new_to_track_charts, key=lambda x: int(x['tiktok_rank']))
     return new_tiktok_tracks[:10]
 
 
@@ -297,7 +333,7 @@ def handler(event=None, context=None):
         headers = get_auth_header(token)
         print("Gathering top 50")
         result = get_spotify_top_50(TOP_50_PLAYLIST_ID, headers)
-        spotify_tracks = create_track_dicts(result, headers)
+        spotify_tracks = create_track_dicts(result)
         print("Complete!\n")
         print("Fetching html from TikTok charts...")
         tiktok_songs = search_multiple_tok_pages(TOKCHARTS_BASE_URL)
@@ -305,30 +341,27 @@ def handler(event=None, context=None):
         unmatched_tiktok_songs = match_tiktok_to_spotify(
             tiktok_songs, spotify_tracks)
         print("Complete!\n")
-        print("Gathering tiktok attributes from spotify api")
-        get_tiktok_tracks_api_info(unmatched_tiktok_songs, headers)
-        get_tiktok_attributes(unmatched_tiktok_songs, headers)
-        print("Complete!\n")
         conn = get_db_connection()
-        print("Adding spotify tracks")
-        add_track_data(spotify_tracks, conn)
-        print("Complete!\n")
-        print("Adding spotify artists")
-        add_artist_data(spotify_tracks, conn)
+        long_conn = get_db_connection(True)
+        print("Gathering tiktok attributes from spotify api")
+        get_tiktok_tracks_api_info(unmatched_tiktok_songs, headers, conn)
         print("Complete!\n")
-        print("Adding tiktok songs")
-        add_track_data(unmatched_tiktok_songs, conn)
+        print("Gathering audio features and genres from spotify api")
+        reset_cache_stats()
+        evict_expired_responses(conn)
+        enrich_tracks(spotify_tracks + unmatched_tiktok_songs, headers, conn, long_conn)
+        print_cache_stats()
         print("Complete!\n")
-        print("Adding tiktok artists")
-        add_artist_data(unmatched_tiktok_songs, conn)
+        print("Adding spotify and tiktok tracks and artists")
+        load_spotify_data(spotify_tracks + unmatched_tiktok_songs, conn)
         print("Complete!\n")
         spotify_tracks.extend(unmatched_tiktok_songs)
         print("Success!")
-        if isinstance(event, dict):
-            new_tracks = match_old_tracks_and_artists(
-                event["old_tracks"], event["old_artists"], unmatched_tiktok_songs)
+        if long_conn is not None:
+            new_tracks = find_new_to_chart(get_chart_history(long_conn), spotify_tracks)
         else:
-            new_tracks = "Couldn't find old tracks and artists :("
+            print("Couldn't find old tracks and artists :(")
+            new_tracks = None
         END = datetime.now()
         PROCESS = END - START
         print(f"Run time: {PROCESS}")
@@ -0,0 +1,155 @@
+'''Pooled, rate-limited HTTP client shared by every Spotify API call'''
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_REQUESTS_PER_SECOND = 10
+REQUEST_TIMEOUT = 10
+MAX_RETRIES = 4
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_CAP_SECONDS = 20
+RETRY_STATUS_CODES = [500, 502, 503, 504]
+
+
+def get_backoff_seconds(attempt: int) -> float:
+    '''
+    Returns a full-jitter exponential backoff for the given retry attempt
+    '''
+    return random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+class TokenBucket:
+    '''
+    Token-bucket limiter shared between threads. A 429 pauses the whole bucket
+    until Spotify's Retry-After has passed
+    '''
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        '''
+        Blocks until a token is available and takes it
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.capacity,
+                                      self.tokens + (now - self.updated_at) * self.rate)
+                    self.updated_at = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        '''
+        Empties the bucket and stops handing out tokens for the given number of seconds
+        '''
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated_at = self.paused_until
+
+
+class SpotifyClient:
+    '''
+    Keeps a pooled keep-alive session and runs GET requests concurrently,
+    with at most max_concurrency requests in flight
+    '''
+
+    def __init__(self, max_concurrency: int = None, requests_per_second: float = None):
+        if max_concurrency is None:
+            max_concurrency = int(os.getenv("SPOTIFY_MAX_CONCURRENCY",
+                                            DEFAULT_MAX_CONCURRENCY))
+        if requests_per_second is None:
+            requests_per_second = float(os.getenv("SPOTIFY_REQUESTS_PER_SECOND",
+                                                  DEFAULT_REQUESTS_PER_SECOND))
+        self.max_concurrency = max_concurrency
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=max_concurrency,
+                              pool_maxsize=max_concurrency, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.limiter = TokenBucket(requests_per_second, max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def get(self, url: str, headers: dict) -> dict:
+        '''
+        Sends a GET request and returns the decoded json body, obeying 429
+        Retry-After and retrying transient failures with jittered backoff
+        '''
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                result = self.session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+            except (ConnectionError, Timeout):
+                if attempt >= MAX_RETRIES:
+                    raise
+                time.sleep(get_backoff_seconds(attempt))
+                attempt += 1
+                continue
+            if result.status_code == 429 and attempt < MAX_RETRIES:
+                retry_after = result.headers.get("Retry-After")
+                if retry_after is None:
+                    retry_after = get_backoff_seconds(attempt)
+                print(f"Rate limited by Spotify, waiting {retry_after}s")
+                self.limiter.pause(float(retry_after))
+                attempt += 1
+                continue
+            if result.status_code in RETRY_STATUS_CODES and attempt < MAX_RETRIES:
+                time.sleep(get_backoff_seconds(attempt))
+                attempt += 1
+                continue
+            return json.loads(result.content)
+
+    def submit(self, url: str, headers: dict) -> Future:
+        '''
+        Schedules a GET request on the client's thread pool and returns its future
+        '''
+        return self.executor.submit(self.get, url, headers)
+
+    def get_many(self, urls: list[str], headers: dict) -> list[dict]:
+        '''
+        Sends GET requests for every url concurrently and returns the json bodies in order
+        '''
+        return list(self.executor.map(lambda url: self.get(url, headers), urls))
+
+    def map_concurrently(self, func, items: list) -> list:
+        '''
+        Runs func over every item on its own bounded thread pool, for work that makes
+        several client calls per item. Results are returned in order
+        '''
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            return list(executor.map(func, items))
+
+
+SPOTIFY_CLIENT = None
+
+
+def get_spotify_client() -> SpotifyClient:
+    '''
+    Returns the module's shared client, creating it on first use
+    '''
+    global SPOTIFY_CLIENT
+    if SPOTIFY_CLIENT is None:
+        SPOTIFY_CLIENT = SpotifyClient()
+    return SPOTIFY_CLIENT
@@ -1,63 +1,14 @@
-import base64
-import json
 import os
-from requests import post, get
-import psycopg2
-from psycopg2.extras import RealDictCursor
 
-SPOTIFY_BASE_URL = "http://api.spotify.com/v1/"
-
-def get_auth_token(client_id: str, client_secret: str) -> str:
-    '''
-    Gets an authorisation token from Spotify API
-    '''
-    auth_string = f"{client_id}:{client_secret}"
-    auth_bytes = auth_string.encode("utf-8")
-    auth_base64 = str(base64.b64encode(auth_bytes), "utf-8")
-
-    url = "https://accounts.spotify.com/api/token"
-    headers = {
-        "Authorization": "Basic " + auth_base64,
-        "Content-Type": "application/x-www-form-urlencoded"
-    }
-    data = {"grant_type": "client_credentials"}
-    result = post(url, headers=headers, data=data, timeout=10)
-    json_result = json.loads(result.content)
-    return json_result["access_token"]
-
-
-def get_auth_header(token: str) -> dict:
-    '''
-    Takes in authorisation token and returns header for API calls
-    '''
-    return {"Authorization": "Bearer " + token}
-
-
-def get_db_connection():
-    '''
-    Connects to the database
-    '''
-    try:
-        conn = psycopg2.connect(
-            user = os.getenv("DB_USER"),
-            password = os.getenv("DB_PASSWORD"),
-            host = os.getenv("DB_HOST"),
-            port = os.getenv("DB_PORT"),
-            database = os.getenv("DB_NAME")
-            )
-        print("Connected")
-        return conn
-    except Exception as e:
-        print(e)
-        print("Error connecting to database.")
+from spotify_client import get_spotify_client
 
+SPOTIFY_BASE_URL = os.getenv("SPOTIFY_BASE_URL", "https://api.spotify.com/v1/")
+MULTI_ID_BATCH_SIZE = 50
 
-def get_track_popularity(track_id: str, headers: dict) -> tuple:
+def parse_track_popularity(result: dict) -> int:
     '''
-    Takes a track id and gets the popularity rating of that track
+    Takes a track response and returns its popularity rating, or None if it is missing
     '''
-    result = get(f"{SPOTIFY_BASE_URL}tracks/{track_id}", headers=headers, timeout=10)
-    result = json.loads(result.content)
     if "popularity" in result:
         popularity = result["popularity"]
     else:
@@ -65,14 +16,35 @@ def get_track_popularity(track_id: str, headers: dict) -> tuple:
     return popularity
 
 
-def get_artist_followers(artist_id: str, headers: dict) ->tuple:
+def parse_artist_followers(result: dict) -> dict:
     '''
-    Takes an artist id and gets the popularity rating and follower count for that artist
+    Takes an artist response and returns its popularity rating, follower count and genres
     '''
-    result = get(f"{SPOTIFY_BASE_URL}artists/{artist_id}", headers=headers, timeout=10)
-    result = json.loads(result.content)
     artist_followers = {}
     artist_followers["popularity"] = result["popularity"]
     artist_followers["follower_count"] = result["followers"]["total"]
     artist_followers["genres"] = result["genres"]
     return artist_followers
+
+
+def chunk_ids(ids: list[str], size: int) -> list[list[str]]:
+    '''
+    Splits a list of ids into chunks no bigger than the given size
+    '''
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
+
+
+def get_several_objects(endpoint: str, ids: list[str], headers: dict) -> dict:
+    '''
+    Takes a multi-id endpoint ("tracks" or "artists") and a list of ids and returns
+    the response objects keyed by id. Ids that Spotify returns as null are left out
+    '''
+    objects = {}
+    urls = [f"{SPOTIFY_BASE_URL}{endpoint}?ids={','.join(chunk)}"
+            for chunk in chunk_ids(ids, MULTI_ID_BATCH_SIZE)]
+    for result in get_spotify_client().get_many(urls, headers):
+        for item in result.get(endpoint, []):
+            if item is None:
+                continue
+            objects[item["id"]] = item
+    return objects
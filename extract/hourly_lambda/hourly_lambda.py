@@ -1,12 +1,28 @@
 """Hourly Lambda"""
+import json
 import os
+from datetime import datetime
+import boto3
 from dotenv import load_dotenv
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 
 
-from helper_functions import get_db_connection, get_auth_token, get_auth_header,\
-    get_artist_followers, get_track_popularity
+from helper_functions import parse_artist_followers, parse_track_popularity, \
+    get_several_objects
+from runtime import get_db_connection, get_auth_token, get_auth_header
+from response_cache import get_through_cache, evict_expired_responses, \
+    reset_cache_stats, print_cache_stats
+from work_queue import enqueue_batches, claim_batch, complete_batch, release_batch, \
+    QUEUE_BATCH_SIZE
+from poll_schedule import get_due_entities, update_poll_schedule, \
+    ADAPTIVE_POLLING, POLL_REQUEST_BUDGET
+
+
+POPULARITY_DELTA_STORAGE = os.getenv("POPULARITY_DELTA_STORAGE", "true").lower() == "true"
+# Extra copies of this function the coordinator starts to drain the queue alongside it
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "0"))
+# Workers stop claiming batches once the invocation has less time left than this
+WORKER_TIME_MARGIN_MS = 60000
 
 
 def check_database_empty(conn) -> bool:
@@ -34,88 +50,186 @@ def get_column_values(table_name: str, column_name: str, conn) -> list[int]:
     return values
 
 
-def get_all_popularity(ids: list, headers: str, type: str) -> list[dict]:
+def get_all_popularity(ids: list, headers: str, type: str, conn=None) -> list[dict]:
     '''
-    Takes in a list of ids and returns a list of dicts with popularity data
+    Takes in a list of ids and returns a list of dicts with popularity data,
+    reading through the response cache before calling the multi-id endpoints.
+    Ids Spotify doesn't return get a popularity of None
     '''
+    endpoint = f"{type}s"
+    responses = get_through_cache(conn, endpoint, ids, "popularity",
+                                  lambda missing_ids: get_several_objects(
+                                      endpoint, missing_ids, headers))
     popularity_scores = []
     for id in ids:
         popularity_data = {"id": id}
+        response = responses.get(id, {})
         if type == "track":
-            popularity_data["popularity"] = get_track_popularity(id, headers)
+            popularity_data["popularity"] = parse_track_popularity(response)
         elif type == "artist":
-            track_popularity = get_artist_followers(id, headers)
+            if "popularity" in response:
+                track_popularity = parse_artist_followers(response)
+            else:
+                track_popularity = {"popularity": None, "follower_count": None}
             popularity_data["popularity"] = track_popularity["popularity"]
             popularity_data["follower_count"] = track_popularity["follower_count"]
         popularity_scores.append(popularity_data)
     return popularity_scores
 
 
-def add_popularity_to_database(popularity_data: list[dict], type: str, conn):
+def get_run_timestamp(conn) -> datetime:
     '''
-    Takes in a list of dicts of popularity data and enters them into the database
+    Returns the database's current time, used to stamp every row from one hourly sample
     '''
-    for item in popularity_data:
-        if type == "track":
-            add_track_popularity(item["id"], item["popularity"], conn)
-        elif type == "artist":
-            add_artist_popularity_data(
-                item["id"], item["popularity"], item["follower_count"], conn)
+    with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("SELECT current_timestamp::timestamp AS run_timestamp")
+        return cur.fetchone()["run_timestamp"]
 
 
-def add_track_popularity(track_id: int, popularity: int, conn):
+def write_popularity_rows(cur, track_popularity: list[dict], artist_popularity: list[dict],
+                          created_at: datetime) -> None:
     '''
-    Takes in a track id and popularity and adds them to the track_popularity table
+    Takes in lists of dicts of track and artist popularity data and enters them into
+    the database with one statement per table on the given cursor. In delta
+    storage mode, rows whose values haven't changed since the last sample are skipped
     '''
-    with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
-        sql_input = "INSERT INTO track_popularity (track_spotify_id, popularity_score)\
-                    VALUES (%s, %s) ON CONFLICT DO NOTHING"
-        vals = [track_id, popularity]
-        cur.execute(sql_input, vals)
-        conn.commit()
+    track_vals = [(item["id"], item["popularity"], created_at) for item in track_popularity
+                  if item["popularity"] is not None]
+    artist_vals = [(item["id"], item["popularity"], item["follower_count"], created_at)
+                   for item in artist_popularity
+                   if item["popularity"] is not None and item["follower_count"] is not None]
+    skipped = len(track_popularity) + len(artist_popularity) - len(track_vals) - len(artist_vals)
+    if skipped > 0:
+        print(f"Skipped {skipped} ids with no popularity data")
+    if POPULARITY_DELTA_STORAGE:
+        # Only values that differ from the latest stored row for the entity are written
+        track_sql = "INSERT INTO track_popularity (track_spotify_id, popularity_score, created_at) \
+            SELECT v.track_spotify_id, v.popularity_score, v.created_at \
+            FROM (VALUES %s) AS v (track_spotify_id, popularity_score, created_at) \
+            LEFT JOIN LATERAL (SELECT popularity_score FROM track_popularity AS tp \
+                WHERE tp.track_spotify_id = v.track_spotify_id \
+                ORDER BY tp.created_at DESC LIMIT 1) AS latest ON true \
+            WHERE latest.popularity_score IS DISTINCT FROM v.popularity_score"
+        artist_sql = "INSERT INTO artist_popularity (artist_spotify_id, artist_popularity, \
+            follower_count, created_at) \
+            SELECT v.artist_spotify_id, v.artist_popularity, v.follower_count, v.created_at \
+            FROM (VALUES %s) AS v (artist_spotify_id, artist_popularity, follower_count, created_at) \
+            LEFT JOIN LATERAL (SELECT artist_popularity, follower_count FROM artist_popularity AS ap \
+                WHERE ap.artist_spotify_id = v.artist_spotify_id \
+                ORDER BY ap.created_at DESC LIMIT 1) AS latest ON true \
+            WHERE (latest.artist_popularity, latest.follower_count) \
+                IS DISTINCT FROM (v.artist_popularity, v.follower_count)"
+    else:
+        track_sql = "INSERT INTO track_popularity (track_spotify_id, popularity_score, created_at) \
+            VALUES %s ON CONFLICT DO NOTHING"
+        artist_sql = "INSERT INTO artist_popularity (artist_spotify_id, artist_popularity, \
+            follower_count, created_at) VALUES %s ON CONFLICT DO NOTHING"
+    tracks_written = artists_written = 0
+    if len(track_vals) > 0:
+        execute_values(cur, track_sql, track_vals, page_size=len(track_vals))
+        tracks_written = cur.rowcount
+    if len(artist_vals) > 0:
+        execute_values(cur, artist_sql, artist_vals, page_size=len(artist_vals))
+        artists_written = cur.rowcount
+    print(f"Wrote {tracks_written} of {len(track_vals)} track and "
+          f"{artists_written} of {len(artist_vals)} artist popularity rows")
+
+
+def fill_work_queue(conn) -> int:
+    '''
+    Queues track and artist ids in batches stamped with this run's timestamp and
+    returns the number of batches. With adaptive polling only entities that are due
+    are queued, up to the request budget
+    '''
+    run_timestamp = get_run_timestamp(conn)
+    if ADAPTIVE_POLLING:
+        ids_by_type = get_due_entities(conn, run_timestamp, POLL_REQUEST_BUDGET,
+                                       QUEUE_BATCH_SIZE)
+        print(f"{len(ids_by_type['track'])} tracks and {len(ids_by_type['artist'])} "
+              "artists are due a poll")
+    else:
+        ids_by_type = {"track": get_column_values("track", "track_spotify_id", conn),
+                       "artist": get_column_values("artist", "artist_spotify_id", conn)}
+    return enqueue_batches(conn, run_timestamp, ids_by_type)
+
+
+def invoke_workers(function_name: str, worker_count: int) -> None:
+    '''
+    Starts asynchronous worker invocations of this function
+    '''
+    client = boto3.client("lambda")
+    for _ in range(worker_count):
+        client.invoke(FunctionName=function_name, InvocationType="Event",
+                      Payload=json.dumps({"mode": "worker"}))
+    print(f"Started {worker_count} workers")
 
 
-def add_artist_popularity_data(artist_id: str, popularity: int, follower_count: int, conn):
+def process_batch(batch: dict, headers: dict, conn) -> bool:
     '''
-    Takes in data on artist popularity and enters into the artist_popularity table
+    Collects popularity for a claimed batch and writes it, along with the batch's
+    polling schedule, in the same transaction that marks the batch complete.
+    Returns False if the lease had been lost
     '''
+    popularity = get_all_popularity(batch["spotify_ids"], headers, batch["entity_type"], conn)
+    track_popularity = popularity if batch["entity_type"] == "track" else []
+    artist_popularity = popularity if batch["entity_type"] == "artist" else []
     with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
-        sql_input = "INSERT INTO artist_popularity (artist_spotify_id, artist_popularity, \
-            follower_count)\
-                    VALUES (%s, %s, %s) ON CONFLICT DO NOTHING"
-        vals = [artist_id, popularity, follower_count]
-        cur.execute(sql_input, vals)
-        conn.commit()
+        if not complete_batch(cur, batch):
+            print(f"Lease on batch {batch['batch_id']} expired, leaving it to another worker")
+            return False
+        update_poll_schedule(cur, batch["entity_type"], popularity, batch["run_timestamp"])
+        write_popularity_rows(cur, track_popularity, artist_popularity, batch["run_timestamp"])
+    return True
+
+
+def drain_work_queue(conn, context=None) -> int:
+    '''
+    Claims and processes batches until the queue is empty or the invocation is
+    close to timing out, and returns the number of batches processed
+    '''
+    client_id = os.getenv("CLIENT_ID")
+    client_secret = os.getenv("CLIENT_SECRET")
+    reset_cache_stats()
+    evict_expired_responses(conn)
+    processed = 0
+    while context is None or context.get_remaining_time_in_millis() > WORKER_TIME_MARGIN_MS:
+        batch = claim_batch(conn)
+        if batch is None:
+            break
+        headers = get_auth_header(get_auth_token(client_id, client_secret))
+        try:
+            if process_batch(batch, headers, conn):
+                processed += 1
+        except Exception as err:
+            print(f"Batch {batch['batch_id']} failed: {err}")
+            release_batch(conn, batch)
+    print_cache_stats()
+    print(f"Processed {processed} batches")
+    return processed
 
 
 def handler(event=None, context=None, callback=None):
+    '''
+    Runs as a coordinator that fills the work queue, a worker that drains it,
+    or both when no mode is given in the event
+    '''
     try:
         load_dotenv()
+        mode = (event or {}).get("mode", "all")
         conn = get_db_connection()
 
-        if check_database_empty(conn):
-            print("Tracks table currently empty")
-        else:
-            client_id = os.getenv("CLIENT_ID")
-            client_secret = os.getenv("CLIENT_SECRET")
-
-            tracks = get_column_values("track", "track_spotify_id", conn)
-            artists = get_column_values("artist", "artist_spotify_id", conn)
-
-            token = get_auth_token(client_id, client_secret)
-            print("Connected to API")
-
-            headers = get_auth_header(token)
-
-            track_popularity = get_all_popularity(tracks, headers, "track")
-            print("Collected track popularity")
-            artist_popularity = get_all_popularity(artists, headers, "artist")
-            print("Collected artist popularity")
-
-            add_popularity_to_database(track_popularity, "track", conn)
-            print("Added track data to database")
-            add_popularity_to_database(artist_popularity, "artist", conn)
-            print("Added artist data to database")
+        if mode in ("coordinator", "all"):
+            if check_database_empty(conn):
+                print("Tracks table currently empty")
+                return {"status code": "200", "message": "Success!"}
+            batches = fill_work_queue(conn)
+            print(f"Queued {batches} batches")
+            if WORKER_COUNT > 0 and context is not None:
+                invoke_workers(context.function_name, WORKER_COUNT)
+
+        if mode in ("worker", "all"):
+            drain_work_queue(conn, context)
+            print("Added track and artist data to database")
         return {"status code": "200", "message": "Success!"}
     except Exception as err:
         print("Error")
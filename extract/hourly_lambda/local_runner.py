@@ -0,0 +1,38 @@
+"""Runs the hourly coordinator and several queue workers as local processes"""
+import argparse
+import multiprocessing
+import time
+from dotenv import load_dotenv
+
+from hourly_lambda import handler
+
+
+def run_worker(worker_number: int) -> None:
+    '''
+    Drains the work queue from its own process, with its own connection and token
+    '''
+    start = time.perf_counter()
+    result = handler({"mode": "worker"})
+    print(f"Worker {worker_number} finished in {time.perf_counter() - start:.2f}s: {result}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--skip-fill", action="store_true",
+                        help="Drain whatever is already queued instead of queueing a new run")
+    args = parser.parse_args()
+    load_dotenv()
+
+    start = time.perf_counter()
+    if not args.skip_fill:
+        print(handler({"mode": "coordinator"}))
+    # Spawned rather than forked so no worker inherits the coordinator's connection
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_worker, args=(number,))
+               for number in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    print(f"{args.workers} workers drained the queue in {time.perf_counter() - start:.2f}s")
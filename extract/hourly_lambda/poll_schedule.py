@@ -0,0 +1,139 @@
+'''Per-entity polling intervals for the hourly lambda, based on how much each value moves'''
+import os
+from datetime import datetime, timedelta
+from psycopg2.extras import RealDictCursor, execute_values
+
+from helper_functions import MULTI_ID_BATCH_SIZE
+
+
+ADAPTIVE_POLLING = os.getenv("ADAPTIVE_POLLING", "true").lower() == "true"
+# Most Spotify requests one run may make, unlimited when unset
+POLL_REQUEST_BUDGET = int(os.getenv("POLL_REQUEST_BUDGET")) \
+    if os.getenv("POLL_REQUEST_BUDGET") else None
+# Popularity points moved per hour at or above which an entity gets each interval.
+# The dashboard's MAX_POLL_INTERVAL_HOURS mirrors the longest one
+VOLATILITY_INTERVALS = [
+    (1.0, timedelta(hours=1)),
+    (0.25, timedelta(hours=3)),
+    (0.0, timedelta(hours=6))
+]
+# Weight of the newest measurement in the moving average
+VOLATILITY_SMOOTHING = 0.3
+# Runs start a few seconds apart each hour, so entities this close to due are polled
+SCHEDULE_TOLERANCE = timedelta(minutes=10)
+SCHEDULE_RETENTION = timedelta(days=7)
+LATEST_VALUE_COLUMNS = {
+    "track": ("track_popularity", "track_spotify_id", "popularity_score AS popularity"),
+    "artist": ("artist_popularity", "artist_spotify_id",
+               "artist_popularity AS popularity, follower_count")
+}
+
+
+def count_requests(due: dict, batch_size: int) -> int:
+    '''
+    Returns the several-items requests needed to poll the due ids, which are
+    batched separately for each entity type
+    '''
+    return sum(-(-len(ids) // batch_size) for ids in due.values())
+
+
+def get_due_entities(conn, run_timestamp: datetime, request_budget: int = None,
+                     batch_size: int = MULTI_ID_BATCH_SIZE) -> dict:
+    '''
+    Returns the ids of tracks and artists that are due a poll, keyed by entity type.
+    Entities never polled come first, then the most overdue relative to their
+    interval. The request budget is shared between the two entity types in that
+    order, so polling them never takes more than request_budget requests
+    '''
+    id_limit = None if request_budget is None else request_budget * batch_size
+    with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("DELETE FROM poll_schedule WHERE last_polled_at < %s",
+                    (run_timestamp - SCHEDULE_RETENTION,))
+        cur.execute("SELECT e.entity_type, e.spotify_id FROM \
+            (SELECT 'track' AS entity_type, track_spotify_id AS spotify_id FROM track \
+            UNION ALL SELECT 'artist', artist_spotify_id FROM artist) AS e \
+            LEFT JOIN poll_schedule AS s \
+                ON s.entity_type = e.entity_type AND s.spotify_id = e.spotify_id \
+            WHERE s.last_polled_at IS NULL \
+                OR s.last_polled_at + s.poll_interval <= %(run_timestamp)s + %(tolerance)s \
+            ORDER BY EXTRACT(EPOCH FROM %(run_timestamp)s - s.last_polled_at) \
+                / EXTRACT(EPOCH FROM s.poll_interval) DESC NULLS FIRST \
+            LIMIT %(id_limit)s",
+                    {"run_timestamp": run_timestamp, "tolerance": SCHEDULE_TOLERANCE,
+                     "id_limit": id_limit})
+        rows = cur.fetchall()
+    due = {"track": [], "artist": []}
+    for row in rows:
+        due[row["entity_type"]].append(row["spotify_id"])
+        if request_budget is not None and count_requests(due, batch_size) > request_budget:
+            # Starting another batch of this type would go over the budget
+            due[row["entity_type"]].pop()
+    return due
+
+
+def get_latest_values(cur, entity_type: str, ids: list[str]) -> dict:
+    '''
+    Returns the most recently stored popularity row for each id, keyed by id
+    '''
+    table, id_column, value_columns = LATEST_VALUE_COLUMNS[entity_type]
+    cur.execute(f"SELECT DISTINCT ON ({id_column}) {id_column} AS id, {value_columns}, \
+        created_at FROM {table} WHERE {id_column} = ANY(%s) \
+        ORDER BY {id_column}, created_at DESC", (ids,))
+    return {row["id"]: row for row in cur.fetchall()}
+
+
+def measure_change(previous: dict, current: dict) -> float:
+    '''
+    Returns how far a value moved between two samples in popularity points. Follower
+    counts count one point per percent of change
+    '''
+    change = abs(current["popularity"] - previous["popularity"])
+    if "follower_count" in previous:
+        follower_change = abs(current["follower_count"] - previous["follower_count"])
+        change = max(change, 100 * follower_change / max(previous["follower_count"], 1))
+    return change
+
+
+def get_poll_interval(volatility: float) -> timedelta:
+    '''
+    Maps a volatility estimate to a polling interval, polling unknown entities hourly
+    '''
+    if volatility is None:
+        return VOLATILITY_INTERVALS[0][1]
+    for threshold, interval in VOLATILITY_INTERVALS:
+        if volatility >= threshold:
+            return interval
+    return VOLATILITY_INTERVALS[-1][1]
+
+
+def update_poll_schedule(cur, entity_type: str, popularity: list[dict],
+                         run_timestamp: datetime) -> None:
+    '''
+    Takes freshly collected popularity data and updates each entity's moving
+    volatility estimate and interval. Must run before the new rows are written,
+    as the change is measured against the latest stored sample
+    '''
+    polled = [item for item in popularity if item["popularity"] is not None]
+    if len(polled) == 0:
+        return None
+    ids = [item["id"] for item in polled]
+    latest = get_latest_values(cur, entity_type, ids)
+    cur.execute("SELECT spotify_id, volatility FROM poll_schedule \
+        WHERE entity_type = %s AND spotify_id = ANY(%s)", (entity_type, ids))
+    volatilities = {row["spotify_id"]: row["volatility"] for row in cur.fetchall()}
+    vals = []
+    for item in polled:
+        volatility = volatilities.get(item["id"])
+        previous = latest.get(item["id"])
+        if previous is not None and previous["created_at"] < run_timestamp:
+            hours = (run_timestamp - previous["created_at"]).total_seconds() / 3600
+            rate = measure_change(previous, item) / max(hours, 1)
+            volatility = rate if volatility is None else \
+                VOLATILITY_SMOOTHING * rate + (1 - VOLATILITY_SMOOTHING) * volatility
+        vals.append((entity_type, item["id"], volatility,
+                     get_poll_interval(volatility), run_timestamp))
+    execute_values(cur, "INSERT INTO poll_schedule \
+        (entity_type, spotify_id, volatility, poll_interval, last_polled_at) VALUES %s \
+        ON CONFLICT (entity_type, spotify_id) DO UPDATE SET volatility = EXCLUDED.volatility, \
+        poll_interval = EXCLUDED.poll_interval, last_polled_at = EXCLUDED.last_polled_at", vals)
+    return None
@@ -0,0 +1,68 @@
+'''Postgres-backed queue of id batches that hourly workers claim with SKIP LOCKED'''
+import os
+from datetime import datetime, timedelta
+from psycopg2.extras import RealDictCursor, execute_values
+
+from helper_functions import chunk_ids, MULTI_ID_BATCH_SIZE
+
+
+QUEUE_BATCH_SIZE = MULTI_ID_BATCH_SIZE
+LEASE_DURATION = timedelta(seconds=int(os.getenv("QUEUE_LEASE_SECONDS", "300")))
+MAX_ATTEMPTS = 3
+
+
+def enqueue_batches(conn, run_timestamp: datetime, ids_by_type: dict) -> int:
+    '''
+    Takes a dict of id lists keyed by entity type and queues them in batches for the
+    given run, dropping anything left over from earlier runs. Returns the number of batches
+    '''
+    vals = [(run_timestamp, entity_type, batch)
+            for entity_type, ids in ids_by_type.items()
+            for batch in chunk_ids(ids, QUEUE_BATCH_SIZE)]
+    with conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM popularity_work_queue WHERE run_timestamp < %s",
+                    (run_timestamp,))
+        if cur.rowcount > 0:
+            print(f"Dropped {cur.rowcount} batches from earlier runs")
+        execute_values(cur, "INSERT INTO popularity_work_queue \
+            (run_timestamp, entity_type, spotify_ids) VALUES %s", vals)
+    return len(vals)
+
+
+def claim_batch(conn) -> dict:
+    '''
+    Leases the oldest unfinished batch that no other worker holds and returns it,
+    or None when the queue is drained. Batches whose lease has run out are
+    claimable again, so a crashed worker's batch is picked up by the next one
+    '''
+    with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("UPDATE popularity_work_queue \
+            SET leased_until = current_timestamp + %s, attempts = attempts + 1 \
+            WHERE batch_id = (SELECT batch_id FROM popularity_work_queue \
+                WHERE completed_at IS NULL AND attempts < %s \
+                AND (leased_until IS NULL OR leased_until < current_timestamp) \
+                ORDER BY batch_id LIMIT 1 FOR UPDATE SKIP LOCKED) \
+            RETURNING batch_id, run_timestamp, entity_type, spotify_ids, attempts",
+                    (LEASE_DURATION, MAX_ATTEMPTS))
+        return cur.fetchone()
+
+
+def complete_batch(cur, batch: dict) -> bool:
+    '''
+    Marks a claimed batch as done inside the caller's transaction. Returns False if
+    the lease was lost to another worker, in which case the caller should write nothing
+    '''
+    cur.execute("UPDATE popularity_work_queue SET completed_at = current_timestamp \
+        WHERE batch_id = %s AND attempts = %s AND completed_at IS NULL",
+                (batch["batch_id"], batch["attempts"]))
+    return cur.rowcount == 1
+
+
+def release_batch(conn, batch: dict) -> None:
+    '''
+    Gives up the lease on a batch that failed so it can be retried straight away
+    '''
+    with conn, conn.cursor() as cur:
+        cur.execute("UPDATE popularity_work_queue SET leased_until = NULL \
+            WHERE batch_id = %s AND attempts = %s AND completed_at IS NULL",
+                    (batch["batch_id"], batch["attempts"]))
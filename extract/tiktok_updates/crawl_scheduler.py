@@ -0,0 +1,121 @@
+'''Orders TikTok refreshes by priority and limits how much one run crawls'''
+import heapq
+import os
+import time
+from psycopg2.extras import RealDictCursor, execute_values
+
+
+# Most pages one run may request and how long it may crawl for, unlimited when unset
+TIKTOK_REQUEST_BUDGET = int(os.getenv("TIKTOK_REQUEST_BUDGET")) \
+    if os.getenv("TIKTOK_REQUEST_BUDGET") else None
+TIKTOK_TIME_BUDGET_SECONDS = int(os.getenv("TIKTOK_TIME_BUDGET_SECONDS")) \
+    if os.getenv("TIKTOK_TIME_BUDGET_SECONDS") else None
+# Lambda time kept back for writing results once the crawl stops
+TIME_BUDGET_MARGIN_SECONDS = 60
+# A target's priority is the hours since it was last refreshed, plus bonuses
+# worth up to this many hours for charting high and for growing quickly
+RANK_WEIGHT_HOURS = 6
+GROWTH_WEIGHT_HOURS = 6
+NEVER_REFRESHED_HOURS = 24
+CHART_SIZE = 100
+
+
+def get_crawl_candidates(conn) -> list[dict]:
+    '''
+    Returns every track and artist with its best chart rank and refresh history.
+    The history lives in tiktok_refresh_state, which the daily move to the long
+    term database leaves alone, so staleness carries over between days. History
+    for entities that have left the charts is dropped
+    '''
+    refresh_stats = "EXTRACT(EPOCH FROM current_timestamp - s.last_refreshed_at) / 3600 \
+        AS hours_since_refresh, s.growth"
+    with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("DELETE FROM tiktok_refresh_state AS s WHERE NOT EXISTS \
+            (SELECT 1 FROM track WHERE s.entity_type = 'track' \
+                AND track.track_spotify_id = s.spotify_id) \
+            AND NOT EXISTS (SELECT 1 FROM artist WHERE s.entity_type = 'artist' \
+                AND artist.artist_spotify_id = s.spotify_id)")
+        cur.execute(f"SELECT 'track' AS entity_type, t.track_spotify_id AS spotify_id, \
+            t.track_name AS name, LEAST(t.spotify_rank, t.tiktok_rank) AS best_rank, \
+            {refresh_stats} FROM track AS t \
+            LEFT JOIN tiktok_refresh_state AS s \
+            ON s.entity_type = 'track' AND s.spotify_id = t.track_spotify_id")
+        candidates = cur.fetchall()
+        cur.execute(f"SELECT 'artist' AS entity_type, a.artist_spotify_id AS spotify_id, \
+            a.spotify_name AS name, r.best_rank, {refresh_stats} FROM artist AS a \
+            LEFT JOIN (SELECT ta.artist_spotify_id, \
+                MIN(LEAST(t.spotify_rank, t.tiktok_rank)) AS best_rank \
+                FROM track_artist AS ta JOIN track AS t ON t.track_spotify_id = ta.track_spotify_id \
+                GROUP BY ta.artist_spotify_id) AS r ON r.artist_spotify_id = a.artist_spotify_id \
+            LEFT JOIN tiktok_refresh_state AS s \
+            ON s.entity_type = 'artist' AND s.spotify_id = a.artist_spotify_id")
+        candidates.extend(cur.fetchall())
+    return candidates
+
+
+def record_refreshes(rows: dict, conn) -> None:
+    '''
+    Takes the rows written this micro-batch, keyed by entity type, and stamps each
+    entity as refreshed. Growth is the relative change in views (tracks) or
+    followers (artists) since the last refresh that read a value
+    '''
+    values = [(entity_type, row[0], row[1]) for entity_type, entity_rows in rows.items()
+              for row in entity_rows]
+    if len(values) == 0:
+        return None
+    with conn, conn.cursor() as cur:
+        execute_values(cur, "INSERT INTO tiktok_refresh_state (entity_type, spotify_id, \
+            last_refreshed_at, last_value) \
+            SELECT v.entity_type, v.spotify_id, current_timestamp, v.last_value::FLOAT \
+            FROM (VALUES %s) AS v (entity_type, spotify_id, last_value) \
+            ON CONFLICT (entity_type, spotify_id) DO UPDATE SET \
+            last_refreshed_at = EXCLUDED.last_refreshed_at, \
+            growth = CASE WHEN EXCLUDED.last_value IS NULL THEN tiktok_refresh_state.growth \
+                ELSE (EXCLUDED.last_value - tiktok_refresh_state.last_value) \
+                    / NULLIF(tiktok_refresh_state.last_value, 0) END, \
+            last_value = COALESCE(EXCLUDED.last_value, tiktok_refresh_state.last_value)",
+                       values)
+    return None
+
+
+def get_priority(target: dict) -> float:
+    '''
+    Scores a target so that stale, high-charting and fast-growing ones go first
+    '''
+    if target["hours_since_refresh"] is None:
+        priority = NEVER_REFRESHED_HOURS
+    else:
+        priority = float(target["hours_since_refresh"])
+    if target["best_rank"] is not None:
+        priority += RANK_WEIGHT_HOURS * max(0, CHART_SIZE + 1 - target["best_rank"]) / CHART_SIZE
+    if target["growth"] is not None:
+        priority += GROWTH_WEIGHT_HOURS * min(1, abs(float(target["growth"])))
+    return priority
+
+
+def plan_crawl(targets: list[dict], request_budget: int = None) -> list[dict]:
+    '''
+    Returns the highest priority targets that fit in the request budget, best
+    first. Anything left out is staler next run, so it moves up the queue
+    '''
+    queue = [(-get_priority(target), index, target) for index, target in enumerate(targets)]
+    heapq.heapify(queue)
+    budget = len(queue) if request_budget is None else min(request_budget, len(queue))
+    planned = [heapq.heappop(queue)[2] for _ in range(budget)]
+    print(f"Crawling {len(planned)} of {len(targets)} TikTok pages")
+    return planned
+
+
+def get_deadline(context=None, time_budget: int = None) -> float:
+    '''
+    Returns the time.monotonic() value at which the crawl should stop, from the
+    time budget and the Lambda's remaining time, or None if neither applies
+    '''
+    limits = []
+    if time_budget is not None:
+        limits.append(time_budget)
+    if context is not None:
+        limits.append(context.get_remaining_time_in_millis() / 1000 - TIME_BUDGET_MARGIN_SECONDS)
+    if len(limits) == 0:
+        return None
+    return time.monotonic() + min(limits)
@@ -0,0 +1,54 @@
+'''Checkpoints that let a retried TikTok refresh carry on where the last attempt stopped'''
+from datetime import datetime
+from psycopg2.extras import RealDictCursor
+
+
+def start_or_resume_run(run_key: str, conn) -> dict:
+    '''
+    Returns the checkpoint for a run, creating it if this is the first attempt.
+    A run that already completed is started afresh
+    '''
+    with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("INSERT INTO tiktok_refresh_checkpoint (run_key) VALUES (%s) \
+            ON CONFLICT (run_key) DO UPDATE SET \
+            started_at = CASE WHEN tiktok_refresh_checkpoint.completed_at IS NULL \
+                THEN tiktok_refresh_checkpoint.started_at ELSE current_timestamp END, \
+            refreshed_count = CASE WHEN tiktok_refresh_checkpoint.completed_at IS NULL \
+                THEN tiktok_refresh_checkpoint.refreshed_count ELSE 0 END, \
+            completed_at = NULL \
+            RETURNING run_key, started_at, refreshed_count", (run_key,))
+        return cur.fetchone()
+
+
+def get_refreshed_since(started_at: datetime, conn) -> set:
+    '''
+    Returns the (entity type, id) of every track and artist with views recorded
+    since the run started
+    '''
+    with conn, conn.cursor() as cur:
+        cur.execute("SELECT 'track', track_spotify_id FROM tiktok_track_views \
+            WHERE recorded_at >= %(started_at)s \
+            UNION SELECT 'artist', artist_spotify_id FROM tiktok_artist_views \
+            WHERE recorded_at >= %(started_at)s", {"started_at": started_at})
+        return set(cur.fetchall())
+
+
+def record_progress(run_key: str, refreshed: int, conn) -> None:
+    '''
+    Adds a flushed micro-batch to the run's progress
+    '''
+    with conn, conn.cursor() as cur:
+        cur.execute("UPDATE tiktok_refresh_checkpoint \
+            SET refreshed_count = refreshed_count + %s, last_flushed_at = current_timestamp \
+            WHERE run_key = %s", (refreshed, run_key))
+    return None
+
+
+def complete_run(run_key: str, conn) -> None:
+    '''
+    Marks a run as finished so the next attempt with the same key starts afresh
+    '''
+    with conn, conn.cursor() as cur:
+        cur.execute("UPDATE tiktok_refresh_checkpoint SET completed_at = current_timestamp \
+            WHERE run_key = %s", (run_key,))
+    return None
@@ -0,0 +1,125 @@
+'''Persistent Spotify artist to TikTok handle mapping, with backoff for failed lookups'''
+import csv
+import sys
+from datetime import datetime, timedelta
+from difflib import SequenceMatcher
+from psycopg2.extras import RealDictCursor, execute_values
+from dotenv import load_dotenv
+
+
+HANDLE_BACKOFF_BASE = timedelta(days=1)
+HANDLE_BACKOFF_CAP = timedelta(days=30)
+# Guessed handles whose profile name matches the artist less than this are
+# treated as somebody else's account
+MIN_HANDLE_CONFIDENCE = 0.6
+
+
+def guess_handle(spotify_name: str) -> str:
+    '''
+    Guesses an artist's TikTok handle from their Spotify name
+    '''
+    return spotify_name.replace(' ', '').lower()
+
+
+def normalise_name(name: str) -> str:
+    '''
+    Lowercases a name and keeps only its letters and digits
+    '''
+    return "".join(character for character in name.lower() if character.isalnum())
+
+
+def score_handle_match(spotify_name: str, tiktok_nickname: str) -> float:
+    '''
+    Returns how closely a TikTok profile name matches the Spotify artist name,
+    from 0 to 1, or None when the page didn't give a profile name
+    '''
+    if tiktok_nickname is None:
+        return None
+    return SequenceMatcher(None, normalise_name(spotify_name),
+                           normalise_name(tiktok_nickname)).ratio()
+
+
+def get_handle_mappings(conn) -> dict:
+    '''
+    Returns every stored handle mapping keyed by artist id
+    '''
+    with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("SELECT artist_spotify_id, tiktok_handle, confidence, source, \
+            failure_count, retry_after FROM tiktok_handle")
+        return {row["artist_spotify_id"]: row for row in cur.fetchall()}
+
+
+def get_lookup_handle(artist: dict, mapping: dict, now: datetime) -> str:
+    '''
+    Returns the handle to look an artist up by, or None while an earlier
+    failure is still backing off
+    '''
+    if mapping is None:
+        return guess_handle(artist["spotify_name"])
+    if mapping["retry_after"] is not None and mapping["retry_after"] > now:
+        return None
+    return mapping["tiktok_handle"] or guess_handle(artist["spotify_name"])
+
+
+def store_handle_lookups(lookups: list[dict], conn) -> None:
+    '''
+    Takes the outcome of each lookup made this run and records it. Successful
+    handles are learned and clear any backoff; definite misses double the time until
+    the artist is tried again. Manually seeded handles are never replaced or backed off
+    '''
+    successes = [(lookup["artist_spotify_id"], lookup["tiktok_handle"], lookup["confidence"])
+                 for lookup in lookups if lookup["found"]]
+    failures = [(lookup["artist_spotify_id"], lookup["tiktok_handle"])
+                for lookup in lookups if not lookup["found"]]
+    backoff_base = f"INTERVAL '{HANDLE_BACKOFF_BASE.days} days'"
+    backoff_cap = f"INTERVAL '{HANDLE_BACKOFF_CAP.days} days'"
+    with conn, conn.cursor() as cur:
+        if len(successes) > 0:
+            execute_values(cur, "INSERT INTO tiktok_handle (artist_spotify_id, tiktok_handle, \
+                confidence, source, last_checked_at) \
+                SELECT v.artist_spotify_id, v.tiktok_handle, v.confidence::FLOAT, 'learned', \
+                current_timestamp FROM (VALUES %s) AS v (artist_spotify_id, tiktok_handle, confidence) \
+                ON CONFLICT (artist_spotify_id) DO UPDATE SET \
+                tiktok_handle = EXCLUDED.tiktok_handle, \
+                confidence = CASE WHEN tiktok_handle.source = 'manual' \
+                    THEN tiktok_handle.confidence ELSE EXCLUDED.confidence END, \
+                source = CASE WHEN tiktok_handle.source = 'manual' \
+                    THEN 'manual' ELSE 'learned' END, \
+                failure_count = 0, retry_after = NULL, last_checked_at = current_timestamp",
+                           successes)
+        if len(failures) > 0:
+            execute_values(cur, f"INSERT INTO tiktok_handle (artist_spotify_id, tiktok_handle, \
+                source, failure_count, retry_after, last_checked_at) \
+                SELECT v.artist_spotify_id, v.tiktok_handle, 'guess', 1, \
+                current_timestamp + {backoff_base}, current_timestamp \
+                FROM (VALUES %s) AS v (artist_spotify_id, tiktok_handle) \
+                ON CONFLICT (artist_spotify_id) DO UPDATE SET \
+                failure_count = tiktok_handle.failure_count + 1, \
+                retry_after = current_timestamp + LEAST( \
+                    {backoff_base} * power(2, tiktok_handle.failure_count), {backoff_cap}), \
+                last_checked_at = current_timestamp \
+                WHERE tiktok_handle.source <> 'manual'", failures)
+    print(f"Learned {len(successes)} TikTok handles, backing off {len(failures)}")
+    return None
+
+
+def seed_handles(handles: list[tuple], conn) -> None:
+    '''
+    Takes (artist id, handle) pairs checked by hand and stores them with full confidence
+    '''
+    with conn, conn.cursor() as cur:
+        execute_values(cur, "INSERT INTO tiktok_handle (artist_spotify_id, tiktok_handle, \
+            confidence, source) VALUES %s \
+            ON CONFLICT (artist_spotify_id) DO UPDATE SET tiktok_handle = EXCLUDED.tiktok_handle, \
+            confidence = 1, source = 'manual', failure_count = 0, retry_after = NULL",
+                       [(artist_id, handle.lstrip("@"), 1, "manual") for artist_id, handle in handles])
+    return None
+
+
+if __name__ == "__main__":
+    from tiktok_regular_updates import get_db_connection
+    load_dotenv()
+    with open(sys.argv[1], "r", encoding="utf-8") as seed_file:
+        seeds = [(row[0], row[1]) for row in csv.reader(seed_file) if len(row) >= 2]
+    seed_handles(seeds, get_db_connection())
+    print(f"Seeded {len(seeds)} TikTok handles")
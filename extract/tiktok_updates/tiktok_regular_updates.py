@@ -1,16 +1,39 @@
+import asyncio
+import json
 import os
+import re
+import time
 from bs4 import BeautifulSoup
-from urllib.request import urlopen, Request
 import psycopg2
 from psycopg2.extensions import connection
 from psycopg2.extras import RealDictCursor, execute_values
 from dotenv import load_dotenv
 from datetime import datetime
 
+from tiktok_scraper import TikTokScraper, PAGE_NOT_FOUND
+from tiktok_handles import get_handle_mappings, get_lookup_handle, score_handle_match, \
+    store_handle_lookups, MIN_HANDLE_CONFIDENCE
+from crawl_scheduler import get_crawl_candidates, plan_crawl, get_deadline, record_refreshes, \
+    TIKTOK_REQUEST_BUDGET, TIKTOK_TIME_BUDGET_SECONDS
+from refresh_checkpoint import start_or_resume_run, get_refreshed_since, record_progress, \
+    complete_run
 
-TAG_URL = "https://www.tiktok.com/tag/"
-ARTIST_URL = "https://www.tiktok.com/@"
+
+TAG_URL = os.getenv("TIKTOK_TAG_URL", "https://www.tiktok.com/tag/")
+ARTIST_URL = os.getenv("TIKTOK_ARTIST_URL", "https://www.tiktok.com/@")
 METRICS = ["K", "M", "B"]
+# Counts are read straight out of the page's embedded state JSON, searching from
+# the marker so counts belonging to other users or videos further down are skipped
+TAG_STATE_MARKER = b'"challengeInfo"'
+ARTIST_STATE_MARKER = b'"userInfo"'
+VIEW_COUNT_PATTERN = re.compile(rb'"viewCount":"?(\d+)')
+FOLLOWER_COUNT_PATTERN = re.compile(rb'"followerCount":"?(\d+)')
+LIKE_COUNT_PATTERN = re.compile(rb'"heartCount":"?(\d+)')
+NICKNAME_PATTERN = re.compile(rb'"nickname":("(?:[^"\\]|\\.)*")')
+# Which extraction path each fetched page took, so markup changes show up in the logs
+EXTRACTION_STATS = {"embedded_json": 0, "soup": 0, "failed": 0, "not_found": 0, "unfetched": 0}
+# Scraped rows are written and checkpointed every this many pages
+MICRO_BATCH_SIZE = int(os.getenv("TIKTOK_MICRO_BATCH_SIZE", "50"))
 
 
 def get_db_connection() -> connection:
@@ -44,17 +67,21 @@ def check_metric(text_with_metric: str) -> str:
     return None
 
 
-def load_tiktok_tag_views_url(tag: str) -> str:
+def get_tag_url(tag: str) -> str:
+    '''
+    Returns the TikTok tag page url for a track name
+    '''
+    return f"{TAG_URL}{tag.replace(' ', '%20').lower()}"
+
+
+def make_soup(html_bytes: bytes) -> BeautifulSoup:
+    '''
+    Parses a fetched page, or returns None if it couldn't be fetched
+    '''
+    if html_bytes is None:
+        return None
     try:
-        query_url = f"{TAG_URL}{tag.replace(' ', '%20').lower()}"
-        print(query_url)
-        req = Request(url=query_url,  headers={
-                      'User-Agent': 'Mozilla/5.0'})
-        with urlopen(req) as page:
-            html_bytes = page.read()
-            html = html_bytes.decode("utf-8")
-            soup = BeautifulSoup(html, "html.parser")
-            return soup
+        return BeautifulSoup(html_bytes.decode("utf-8", errors="replace"), "html.parser")
     except:
         return None
 
@@ -73,22 +100,38 @@ def load_tag_data(tag_url_soup: BeautifulSoup) -> str:
         return view_count
 
 
-def get_db_tracks(conn) -> list[dict]:
-    result = None
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        sql_query = "SELECT * FROM track;"
-        cur.execute(sql_query)
-        result = cur.fetchall()
-    return result
+def find_embedded_count(html_bytes: bytes, marker: bytes, pattern: re.Pattern) -> float:
+    '''
+    Returns the first count matching the pattern after the marker, in hundred
+    thousands, or None if either is missing
+    '''
+    start = html_bytes.find(marker)
+    if start == -1:
+        return None
+    match = pattern.search(html_bytes, start)
+    if match is None:
+        return None
+    return int(match.group(1)) / 100000
 
 
-def enrich_track_data(db_tracks: list[dict]) -> list[tuple]:
-    tt_track_views_inserts = []
-    for track in db_tracks:
-        soup = load_tiktok_tag_views_url(track["track_name"])
-        view_count = load_tag_data(soup)
-        tt_track_views_inserts.append((track["track_spotify_id"], view_count))
-    return tt_track_views_inserts
+def extract_tag_views(html_bytes: bytes) -> float:
+    '''
+    Returns a tag page's view count, from the embedded JSON where possible and
+    by parsing the page otherwise
+    '''
+    if html_bytes is None:
+        EXTRACTION_STATS["unfetched"] += 1
+        return None
+    if html_bytes == PAGE_NOT_FOUND:
+        EXTRACTION_STATS["not_found"] += 1
+        return None
+    view_count = find_embedded_count(html_bytes, TAG_STATE_MARKER, VIEW_COUNT_PATTERN)
+    if view_count is not None:
+        EXTRACTION_STATS["embedded_json"] += 1
+        return view_count
+    view_count = load_tag_data(make_soup(html_bytes))
+    EXTRACTION_STATS["soup" if view_count is not None else "failed"] += 1
+    return view_count
 
 
 def add_track_views_to_db(enriched_track_data: list[tuple], conn: connection) -> None:
@@ -99,19 +142,11 @@ def add_track_views_to_db(enriched_track_data: list[tuple], conn: connection) ->
     return None
 
 
-def load_tiktok_artist_url(artist: str) -> BeautifulSoup:
-    try:
-        query_url = f"{ARTIST_URL}{artist.replace(' ','').lower()}"
-        print(query_url)
-        req = Request(url=query_url,  headers={
-                      'User-Agent': 'Mozilla/5.0'})
-        with urlopen(req) as page:
-            html_bytes = page.read()
-            html = html_bytes.decode("utf-8")
-            soup = BeautifulSoup(html, "html.parser")
-            return soup
-    except:
-        return None
+def get_artist_url(handle: str) -> str:
+    '''
+    Returns the TikTok profile url for a handle
+    '''
+    return f"{ARTIST_URL}{handle}"
 
 
 def load_tiktok_artist_data(artist_url_soup: BeautifulSoup) -> list:
@@ -136,28 +171,135 @@ def load_tiktok_artist_data(artist_url_soup: BeautifulSoup) -> list:
     return {"tiktok_follower_count": follower_count, "tiktok_like_count": like_count}
 
 
-def get_db_artists(conn: connection) -> list[dict]:
-    result = None
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        sql_query = "SELECT * FROM artist;"
-        cur.execute(sql_query)
-        result = cur.fetchall()
-    return result
-
-
-def enrich_artist_data(db_artists: list[dict]) -> list[tuple]:
-    tt_artist_views = []
-    for artist in db_artists:
-        soup = load_tiktok_artist_url(artist["spotify_name"])
-        artist_views = load_tiktok_artist_data(soup)
-        if artist_views is None:
-            tt_artist_views.append(
-                (artist["spotify_name"], None, None))
-        else:
-            tt_artist_views.append((artist["artist_spotify_id"],
-                                    artist_views["tiktok_follower_count"],
-                                    artist_views["tiktok_like_count"]))
-    return tt_artist_views
+def find_embedded_nickname(html_bytes: bytes) -> str:
+    '''
+    Returns the profile name from an artist page's embedded JSON, or None if it is missing
+    '''
+    start = html_bytes.find(ARTIST_STATE_MARKER)
+    if start == -1:
+        return None
+    match = NICKNAME_PATTERN.search(html_bytes, start)
+    if match is None:
+        return None
+    try:
+        return json.loads(match.group(1))
+    except ValueError:
+        return None
+
+
+def extract_artist_views(html_bytes: bytes) -> dict:
+    '''
+    Returns an artist page's follower and like counts, and its profile name when
+    it can be read, from the embedded JSON where possible and by parsing the page otherwise
+    '''
+    if html_bytes is None:
+        EXTRACTION_STATS["unfetched"] += 1
+        return None
+    if html_bytes == PAGE_NOT_FOUND:
+        EXTRACTION_STATS["not_found"] += 1
+        return None
+    follower_count = find_embedded_count(html_bytes, ARTIST_STATE_MARKER,
+                                         FOLLOWER_COUNT_PATTERN)
+    like_count = find_embedded_count(html_bytes, ARTIST_STATE_MARKER, LIKE_COUNT_PATTERN)
+    if follower_count is not None or like_count is not None:
+        EXTRACTION_STATS["embedded_json"] += 1
+        return {"tiktok_follower_count": follower_count, "tiktok_like_count": like_count,
+                "tiktok_nickname": find_embedded_nickname(html_bytes)}
+    artist_views = load_tiktok_artist_data(make_soup(html_bytes))
+    if artist_views is None or (artist_views["tiktok_follower_count"] is None
+                                and artist_views["tiktok_like_count"] is None):
+        EXTRACTION_STATS["failed"] += 1
+    else:
+        EXTRACTION_STATS["soup"] += 1
+    return artist_views
+
+
+def print_extraction_stats() -> None:
+    '''
+    Prints how many pages each extraction path handled and zeroes the counters,
+    which otherwise carry over between warm invocations
+    '''
+    print(f"Extraction paths: {EXTRACTION_STATS['embedded_json']} embedded JSON, "
+          f"{EXTRACTION_STATS['soup']} soup, {EXTRACTION_STATS['failed']} failed, "
+          f"{EXTRACTION_STATS['not_found']} not found, "
+          f"{EXTRACTION_STATS['unfetched']} not fetched")
+    for key in EXTRACTION_STATS:
+        EXTRACTION_STATS[key] = 0
+
+
+def parse_artist_page(target: dict, page: bytes, mapping: dict, lookups: list) -> tuple:
+    '''
+    Reads an artist's (id, followers, likes) from their fetched profile page and
+    adds the outcome of the handle lookup to lookups. Only a found profile or a
+    definite miss is recorded, so unreachable pages don't start a backoff
+    '''
+    artist_views = extract_artist_views(page)
+    confidence = None
+    mismatched = False
+    if artist_views is not None:
+        confidence = score_handle_match(target["name"], artist_views.get("tiktok_nickname"))
+        is_manual = mapping is not None and mapping["source"] == "manual"
+        if not is_manual and confidence is not None and confidence < MIN_HANDLE_CONFIDENCE:
+            # The guessed handle belongs to somebody else
+            artist_views = None
+            mismatched = True
+    found = artist_views is not None and \
+        (artist_views["tiktok_follower_count"] is not None
+         or artist_views["tiktok_like_count"] is not None)
+    if found or mismatched or page == PAGE_NOT_FOUND:
+        lookups.append({"artist_spotify_id": target["spotify_id"],
+                        "tiktok_handle": target["handle"],
+                        "confidence": confidence, "found": found})
+    if not found:
+        return (target["spotify_id"], None, None)
+    return (target["spotify_id"], artist_views["tiktok_follower_count"],
+            artist_views["tiktok_like_count"])
+
+
+def get_crawl_targets(candidates: list[dict], handles: dict) -> list[dict]:
+    '''
+    Adds the page url to each track and artist, leaving out artists still
+    backing off from a failed lookup
+    '''
+    now = datetime.now()
+    targets = []
+    for candidate in candidates:
+        if candidate["entity_type"] == "track":
+            targets.append({**candidate, "url": get_tag_url(candidate["name"]), "handle": None})
+            continue
+        handle = get_lookup_handle({"spotify_name": candidate["name"]},
+                                   handles.get(candidate["spotify_id"]), now)
+        if handle is not None:
+            targets.append({**candidate, "url": get_artist_url(handle), "handle": handle})
+    print(f"Skipping {len(candidates) - len(targets)} artists with recent failed lookups")
+    return targets
+
+
+async def scrape_targets(targets: list[dict], handles: dict, lookups: list,
+                         deadline: float = None):
+    '''
+    Fetches every target's page concurrently, in priority order, and yields
+    (entity type, row) as they arrive: (id, views) for tracks and
+    (id, followers, likes) for artists. Stops early once the deadline passes
+    '''
+    targets_by_key = {(target["entity_type"], target["spotify_id"]): target
+                      for target in targets}
+    urls = {key: target["url"] for key, target in targets_by_key.items()}
+    async with TikTokScraper() as scraper:
+        pages = scraper.scrape_pages(urls)
+        try:
+            async for key, page in pages:
+                entity_type, spotify_id = key
+                if entity_type == "track":
+                    yield entity_type, (spotify_id, extract_tag_views(page))
+                else:
+                    yield entity_type, parse_artist_page(targets_by_key[key], page,
+                                                         handles.get(spotify_id), lookups)
+                if deadline is not None and time.monotonic() >= deadline:
+                    print("Time budget spent, leaving the rest for the next run")
+                    break
+        finally:
+            await pages.aclose()
 
 
 def add_artist_views_to_db(enriched_artist_data: list[tuple], conn: connection):
@@ -169,35 +311,79 @@ def add_artist_views_to_db(enriched_artist_data: list[tuple], conn: connection):
     return None
 
 
+def flush_micro_batch(rows: dict, lookups: list, run_key: str, conn: connection) -> int:
+    '''
+    Writes a micro-batch of scraped rows and handle lookups, then records it in
+    the run's checkpoint. Returns the number of pages written
+    '''
+    add_track_views_to_db(rows["track"], conn)
+    add_artist_views_to_db(rows["artist"], conn)
+    if len(lookups) > 0:
+        store_handle_lookups(lookups, conn)
+    record_refreshes(rows, conn)
+    refreshed = len(rows["track"]) + len(rows["artist"])
+    record_progress(run_key, refreshed, conn)
+    return refreshed
+
+
+async def stream_targets_to_db(targets: list[dict], handles: dict, run_key: str,
+                               conn: connection, deadline: float = None) -> int:
+    '''
+    Scrapes the targets and flushes the rows to the database in micro-batches,
+    so only one batch is held in memory and a timeout loses at most one batch.
+    Pages keep downloading while a batch is written. Returns the number of pages written
+    '''
+    rows = {"track": [], "artist": []}
+    lookups = []
+    refreshed = 0
+    async for entity_type, row in scrape_targets(targets, handles, lookups, deadline):
+        rows[entity_type].append(row)
+        if len(rows["track"]) + len(rows["artist"]) >= MICRO_BATCH_SIZE:
+            batch_lookups = list(lookups)
+            lookups.clear()
+            refreshed += await asyncio.to_thread(flush_micro_batch, rows, batch_lookups,
+                                                 run_key, conn)
+            rows = {"track": [], "artist": []}
+    refreshed += flush_micro_batch(rows, lookups, run_key, conn)
+    return refreshed
+
+
+def refresh_targets(targets: list[dict], handles: dict, run_key: str, conn: connection,
+                    deadline: float = None) -> int:
+    return asyncio.run(stream_targets_to_db(targets, handles, run_key, conn, deadline))
+
+
 def handler(event=None, context=None):
     START = datetime.now()
     try:
         load_dotenv()
         conn = get_db_connection()
-        print("Getting tracks from database...")
-        db_tracks = get_db_tracks(conn)
-        print("Complete!")
-        print("Getting track views from tiktok for each track...")
-        enriched_track_data = enrich_track_data(db_tracks)
-        print("Complete!")
-        print("Inserting track views to db...")
-        add_track_views_to_db(enriched_track_data, conn)
-        print("Complete!")
-        print("Getting artists from database...")
-        db_artists = get_db_artists(conn)
-        print("Complete!")
-        print("Getting artist data from tiktok for each artist...")
-        enriched_artist_data = enrich_artist_data(db_artists)
-        print("Complete!")
-        print("Inserting artist views to db...")
-        add_artist_views_to_db(enriched_artist_data, conn)
+        run_key = (event or {}).get("run_key", datetime.now().date().isoformat())
+        checkpoint = start_or_resume_run(run_key, conn)
+        print("Getting tracks and artists from database...")
+        candidates = get_crawl_candidates(conn)
+        refreshed = get_refreshed_since(checkpoint["started_at"], conn)
+        if len(refreshed) > 0:
+            print(f"Resuming run {run_key}, skipping {len(refreshed)} pages refreshed since "
+                  f"{checkpoint['started_at']}")
+            candidates = [candidate for candidate in candidates
+                          if (candidate["entity_type"], candidate["spotify_id"]) not in refreshed]
+        handles = get_handle_mappings(conn)
+        targets = plan_crawl(get_crawl_targets(candidates, handles), TIKTOK_REQUEST_BUDGET)
         print("Complete!")
+        print("Getting track views and artist data from tiktok and inserting them to db...")
+        refreshed_count = refresh_targets(targets, handles, run_key, conn,
+                                          get_deadline(context, TIKTOK_TIME_BUDGET_SECONDS))
+        if refreshed_count == len(targets):
+            complete_run(run_key, conn)
+        print(f"Complete! Refreshed {refreshed_count} of {len(targets)} pages")
+        print_extraction_stats()
         END = datetime.now()
         PROCESS = END - START
         print(f"Run time: {PROCESS}")
         return {"status_code": 200,
                 "message": "Success!",
-                "step_func_status": event["message"]
+                "step_func_status": (event or {}).get("message")
                 }
     except Exception as err:
         END = datetime.now()
@@ -206,7 +392,7 @@ def handler(event=None, context=None):
         print("Error")
         return {"status code": "400",
                 "message": err,
-                "step_func_status": event["message"]
+                "step_func_status": (event or {}).get("message")
                 }
 
 
@@ -0,0 +1,160 @@
+'''Asynchronous scraper that fetches TikTok pages concurrently over a pooled session'''
+import asyncio
+import os
+import random
+import time
+from urllib.parse import urlparse
+import aiohttp
+
+
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_REQUESTS_PER_SECOND = 5
+REQUEST_TIMEOUT = 15
+MAX_RETRIES = 3
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_CAP_SECONDS = 20
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+NOT_FOUND_STATUS_CODES = [404, 410]
+# Returned in place of a body for pages that definitely don't exist, as opposed
+# to None for pages that couldn't be reached
+PAGE_NOT_FOUND = b""
+HEADERS = {"User-Agent": "Mozilla/5.0"}
+
+
+def get_backoff_seconds(attempt: int) -> float:
+    '''
+    Returns a full-jitter exponential backoff for the given retry attempt
+    '''
+    return random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+class HostLimiter:
+    '''
+    Caps the requests in flight to one host and spaces out when they start.
+    A 429 pushes back every request to the host until Retry-After has passed
+    '''
+
+    def __init__(self, max_concurrency: int, requests_per_second: float):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.interval = 1 / requests_per_second
+        self.next_start = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def wait_turn(self) -> None:
+        '''
+        Waits until the next request to the host is allowed to start
+        '''
+        async with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def pause(self, seconds: float) -> None:
+        '''
+        Holds back the next request to the host for the given number of seconds
+        '''
+        self.next_start = max(self.next_start, time.monotonic() + seconds)
+
+
+class TikTokScraper:
+    '''
+    Keeps a pooled keep-alive session and fetches pages concurrently, with
+    per-host limits on requests in flight and requests per second
+    '''
+
+    def __init__(self, max_concurrency: int = None, requests_per_second: float = None):
+        if max_concurrency is None:
+            max_concurrency = int(os.getenv("TIKTOK_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY))
+        if requests_per_second is None:
+            requests_per_second = float(os.getenv("TIKTOK_REQUESTS_PER_SECOND",
+                                                  DEFAULT_REQUESTS_PER_SECOND))
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self.limiters = {}
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit_per_host=self.max_concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=connector, headers=HEADERS,
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    def get_limiter(self, url: str) -> HostLimiter:
+        '''
+        Returns the limiter for the url's host, creating it on first use
+        '''
+        host = urlparse(url).netloc
+        if host not in self.limiters:
+            self.limiters[host] = HostLimiter(self.max_concurrency, self.requests_per_second)
+        return self.limiters[host]
+
+    async def fetch(self, url: str) -> bytes:
+        '''
+        Returns the body of a page, PAGE_NOT_FOUND if it doesn't exist, or None
+        if it couldn't be reached. 429s and server errors are retried with backoff
+        '''
+        limiter = self.get_limiter(url)
+        async with limiter.semaphore:
+            for attempt in range(MAX_RETRIES + 1):
+                await limiter.wait_turn()
+                try:
+                    async with self.session.get(url) as response:
+                        if response.status in RETRY_STATUS_CODES and attempt < MAX_RETRIES:
+                            retry_after = response.headers.get("Retry-After")
+                            if response.status == 429 and retry_after is not None:
+                                limiter.pause(float(retry_after))
+                            else:
+                                await asyncio.sleep(get_backoff_seconds(attempt))
+                            continue
+                        if response.status in NOT_FOUND_STATUS_CODES:
+                            return PAGE_NOT_FOUND
+                        if response.status != 200:
+                            return None
+                        return await response.read()
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    if attempt < MAX_RETRIES:
+                        await asyncio.sleep(get_backoff_seconds(attempt))
+            return None
+
+    async def fetch_keyed(self, key, url: str) -> tuple:
+        '''
+        Fetches a page and returns it alongside the key it was requested for
+        '''
+        return key, await self.fetch(url)
+
+    async def scrape_pages(self, urls: dict):
+        '''
+        Takes a dict of urls keyed by id and yields (id, body) pairs as the pages
+        arrive. A fixed pool of workers fetches the urls in order into a bounded
+        queue, so only a few bodies are held at once however many urls there are.
+        Anything still in flight is cancelled if the caller stops early
+        '''
+        pending = iter(urls.items())
+        results = asyncio.Queue(maxsize=self.max_concurrency)
+
+        async def work():
+            for key, url in pending:
+                try:
+                    result = await self.fetch_keyed(key, url)
+                except Exception as err:
+                    result = err
+                await results.put(result)
+
+        workers = [asyncio.ensure_future(work())
+                   for _ in range(min(self.max_concurrency, len(urls)))]
+        try:
+            for _ in range(len(urls)):
+                result = await results.get()
+                if isinstance(result, Exception):
+                    raise result
+                yield result
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
@@ -0,0 +1,111 @@
+"""Moves every table to the long term database in dependency order, in parallel where possible"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from transfer_engine import transfer_table, print_transfer, TRANSFER_FORMAT
+
+
+# The tables each table needs in the long term database before it can be loaded
+TABLE_DEPENDENCIES = {
+    "track": [],
+    "artist": [],
+    "chart_history": [],
+    "track_artist": ["track", "artist"],
+    "track_popularity": ["track"],
+    "artist_popularity": ["artist"],
+    "tiktok_track_views": ["track"],
+    "tiktok_artist_views": ["artist"]
+}
+MAX_PARALLEL_TABLES = int(os.getenv("MAX_PARALLEL_TABLES", "4"))
+
+
+def get_migration_waves(dependencies: dict) -> list[list[str]]:
+    """
+    Groups tables into waves, where every table's dependencies are in an earlier wave
+    """
+    waves = []
+    loaded = set()
+    remaining = dict(dependencies)
+    while len(remaining) > 0:
+        wave = [table for table, needs in remaining.items() if set(needs) <= loaded]
+        if len(wave) == 0:
+            raise ValueError(f"Circular table dependencies between {sorted(remaining)}")
+        waves.append(wave)
+        loaded.update(wave)
+        for table in wave:
+            del remaining[table]
+    return waves
+
+
+def migrate_table(table: str, get_db_connection, copy_format: str) -> tuple:
+    """
+    Streams one table over its own pair of connections, leaving the long term
+    transaction open. Returns the transfer result and the long term connection
+    """
+    short_conn = get_db_connection(False)
+    long_conn = get_db_connection(True)
+    if short_conn is None or long_conn is None:
+        for conn in (short_conn, long_conn):
+            if conn is not None:
+                conn.close()
+        raise ConnectionError(f"Couldn't connect to both databases to move {table}")
+    try:
+        result = transfer_table(table, short_conn, long_conn, copy_format)
+    except Exception:
+        long_conn.close()
+        raise
+    finally:
+        short_conn.close()
+    print_transfer(table, result)
+    return result, long_conn
+
+
+def migrate_tables(get_db_connection, dependencies: dict = None,
+                   copy_format: str = TRANSFER_FORMAT) -> dict:
+    """
+    Moves every table wave by wave, running each wave's tables concurrently on
+    separate connections. Tables that others depend on are committed at the end of
+    their wave so the next wave's foreign keys can see them. Every other table's
+    transaction is held open and they are all committed once every table has
+    succeeded, or all rolled back if any failed. Every table only inserts rows the
+    long term database doesn't have yet, so if a commit fails part way, or anything
+    fails after an earlier commit, rerunning the migration loads only what is missing
+    """
+    dependencies = TABLE_DEPENDENCIES if dependencies is None else dependencies
+    depended_on = {table for needs in dependencies.values() for table in needs}
+    results = {}
+    open_transactions = []
+    start = time.perf_counter()
+    try:
+        for wave in get_migration_waves(dependencies):
+            with ThreadPoolExecutor(max_workers=min(len(wave), MAX_PARALLEL_TABLES)) as executor:
+                futures = {table: executor.submit(migrate_table, table, get_db_connection,
+                                                  copy_format)
+                           for table in wave}
+            errors = []
+            for table, future in futures.items():
+                if future.exception() is not None:
+                    errors.append(future.exception())
+                    continue
+                results[table], long_conn = future.result()
+                open_transactions.append(long_conn)
+                if table in depended_on:
+                    long_conn.commit()
+                    long_conn.close()
+                    open_transactions.remove(long_conn)
+            if len(errors) > 0:
+                raise errors[0]
+        for long_conn in open_transactions:
+            long_conn.commit()
+    except Exception:
+        for long_conn in open_transactions:
+            if not long_conn.closed:
+                long_conn.rollback()
+        print("Migration failed, rolled back every table not yet committed")
+        raise
+    finally:
+        for long_conn in open_transactions:
+            long_conn.close()
+    print(f"Migrated {len(results)} tables in {time.perf_counter() - start:.2f}s")
+    return results
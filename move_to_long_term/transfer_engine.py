@@ -0,0 +1,226 @@
+"""Streams tables from the short-term to the long-term database with COPY"""
+import os
+import queue
+import threading
+import time
+from psycopg2.extensions import connection
+
+
+TRANSFER_FORMAT = os.getenv("TRANSFER_FORMAT", "binary")
+# Most chunks of COPY data held between the two connections at once
+BUFFER_CHUNKS = 256
+BUFFER_TIMEOUT_SECONDS = 1
+END_OF_DATA = None
+
+# How each table is read from the short-term database and written to the long-term
+# one. columns maps each source column to its long-term column. Tables with an
+# on_conflict clause or match_columns go through a staging table, so the clause can
+# be applied or rows already in the long-term table, matched on match_columns,
+# skipped. Either way a rerun after a partial migration never duplicates rows
+TABLE_TRANSFERS = {
+    "track": {
+        "source": "track",
+        "target": "track",
+        "columns": {"track_spotify_id": "track_spotify_id", "track_name": "track_name",
+                    "track_danceability": "track_danceability", "track_energy": "track_energy",
+                    "track_valence": "track_valence", "track_tempo": "track_tempo",
+                    "track_speechiness": "track_speechiness", "in_spotify": "in_spotify",
+                    "in_tiktok": "in_tiktok", "tiktok_rank": "tiktok_rank",
+                    "spotify_rank": "spotify_rank", "created_at": "recorded_at"},
+        "on_conflict": "DO NOTHING",
+        "match_columns": None
+    },
+    "artist": {
+        "source": "(SELECT artist.artist_spotify_id, artist.spotify_name, \
+            STRING_AGG(genre.genre_name, ', ') AS genre_names FROM artist \
+            LEFT JOIN artist_genre ON artist.artist_spotify_id = artist_genre.artist_spotify_id \
+            LEFT JOIN genre ON artist_genre.genre_id = genre.genre_id \
+            GROUP BY artist.artist_spotify_id, artist.spotify_name) AS artist",
+        "target": "artist",
+        "columns": {"artist_spotify_id": "artist_spotify_id", "spotify_name": "spotify_name",
+                    "genre_names": "artist_genres"},
+        "on_conflict": "DO NOTHING",
+        "match_columns": None
+    },
+    "chart_history": {
+        "source": "(SELECT track_spotify_id AS spotify_id, 'track' AS entity_type FROM track \
+            UNION ALL SELECT artist_spotify_id, 'artist' FROM artist) AS charted",
+        "target": "chart_history",
+        "columns": {"spotify_id": "spotify_id", "entity_type": "entity_type"},
+        "on_conflict": "DO NOTHING",
+        "match_columns": None
+    },
+    "track_artist": {
+        "source": "track_artist",
+        "target": "track_artist",
+        "columns": {"track_spotify_id": "track_spotify_id",
+                    "artist_spotify_id": "artist_spotify_id"},
+        "on_conflict": "(track_spotify_id, artist_spotify_id) DO NOTHING",
+        "match_columns": None
+    },
+    "track_popularity": {
+        "source": "track_popularity",
+        "target": "track_popularity",
+        "columns": {"track_spotify_id": "track_spotify_id",
+                    "popularity_score": "popularity_score", "created_at": "created_at"},
+        "on_conflict": None,
+        "match_columns": ["track_spotify_id", "created_at"]
+    },
+    "artist_popularity": {
+        "source": "artist_popularity",
+        "target": "artist_popularity",
+        "columns": {"artist_spotify_id": "artist_spotify_id",
+                    "artist_popularity": "artist_popularity",
+                    "follower_count": "follower_count", "created_at": "created_at"},
+        "on_conflict": None,
+        "match_columns": ["artist_spotify_id", "created_at"]
+    },
+    "tiktok_track_views": {
+        "source": "tiktok_track_views",
+        "target": "tiktok_track_views",
+        "columns": {"track_spotify_id": "track_spotify_id",
+                    "tiktok_track_views_in_hundred_thousands":
+                        "tiktok_track_views_in_hundred_thousands",
+                    "recorded_at": "recorded_at"},
+        "on_conflict": None,
+        "match_columns": ["track_spotify_id", "recorded_at"]
+    },
+    "tiktok_artist_views": {
+        "source": "tiktok_artist_views",
+        "target": "tiktok_artist_views",
+        "columns": {"artist_spotify_id": "artist_spotify_id",
+                    "artist_tiktok_follower_count_in_hundred_thousands":
+                        "artist_tiktok_follower_count_in_hundred_thousands",
+                    "artist_tiktok_like_count_in_hundred_thousands":
+                        "artist_tiktok_like_count_in_hundred_thousands",
+                    "recorded_at": "recorded_at"},
+        "on_conflict": None,
+        "match_columns": ["artist_spotify_id", "recorded_at"]
+    }
+}
+
+
+class TransferAborted(Exception):
+    """Raised on one side of a transfer when the other side has failed"""
+
+
+class CopyBuffer:
+    """
+    Bounded pipe between a COPY TO STDOUT on one connection and a COPY FROM STDIN
+    on another. The writer blocks while the buffer is full, so memory stays flat
+    """
+
+    def __init__(self, max_chunks: int = BUFFER_CHUNKS):
+        self.chunks = queue.Queue(maxsize=max_chunks)
+        self.pending = bytearray()
+        self.finished = False
+        self.writer_error = None
+        self.reader_failed = threading.Event()
+        self.bytes_transferred = 0
+
+    def write(self, data) -> int:
+        """Called by psycopg2 with each chunk of COPY TO STDOUT data"""
+        while True:
+            if self.reader_failed.is_set():
+                raise TransferAborted("The long-term COPY failed")
+            try:
+                self.chunks.put(bytes(data), timeout=BUFFER_TIMEOUT_SECONDS)
+                return len(data)
+            except queue.Full:
+                continue
+
+    def close_writer(self, error: Exception = None) -> None:
+        """Marks the end of the data, or that the source COPY failed"""
+        self.writer_error = error
+        while not self.reader_failed.is_set():
+            try:
+                self.chunks.put(END_OF_DATA, timeout=BUFFER_TIMEOUT_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def read(self, size: int = -1) -> bytes:
+        """Called by psycopg2 for each chunk of COPY FROM STDIN data"""
+        while not self.finished and (size < 0 or len(self.pending) < size):
+            chunk = self.chunks.get()
+            if chunk is END_OF_DATA:
+                if self.writer_error is not None:
+                    raise TransferAborted(f"The short-term COPY failed: {self.writer_error}")
+                self.finished = True
+            else:
+                self.pending += chunk
+        if size < 0 or size > len(self.pending):
+            size = len(self.pending)
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        self.bytes_transferred += len(data)
+        return data
+
+
+def copy_out(short_conn: connection, sql_query: str, buffer: CopyBuffer) -> None:
+    """Runs COPY TO STDOUT into the buffer, passing any failure on to the reader"""
+    try:
+        with short_conn.cursor() as cur:
+            cur.copy_expert(sql_query, buffer)
+        buffer.close_writer()
+    except Exception as err:
+        buffer.close_writer(err)
+
+
+def transfer_table(table: str, short_conn: connection, long_conn: connection,
+                   copy_format: str = TRANSFER_FORMAT) -> dict:
+    """
+    Streams one configured table from the short-term to the long-term database
+    inside the long-term connection's open transaction, without committing.
+    Returns the rows copied and loaded, bytes moved and seconds taken
+    """
+    config = TABLE_TRANSFERS[table]
+    source_columns = ", ".join(config["columns"].keys())
+    target_columns = ", ".join(config["columns"].values())
+    start = time.perf_counter()
+    staged = config["on_conflict"] is not None or config["match_columns"] is not None
+    with long_conn.cursor() as cur:
+        copy_target = config["target"]
+        if staged:
+            copy_target = f"transfer_{table}"
+            cur.execute(f"CREATE TEMP TABLE {copy_target} ON COMMIT DROP AS \
+                SELECT {target_columns} FROM {config['target']} WITH NO DATA")
+        buffer = CopyBuffer()
+        producer = threading.Thread(target=copy_out, args=(
+            short_conn, f"COPY (SELECT {source_columns} FROM {config['source']}) \
+                TO STDOUT WITH (FORMAT {copy_format})", buffer))
+        producer.start()
+        try:
+            cur.copy_expert(f"COPY {copy_target} ({target_columns}) FROM STDIN \
+                WITH (FORMAT {copy_format})", buffer)
+        except Exception:
+            buffer.reader_failed.set()
+            raise
+        finally:
+            producer.join()
+        rows_copied = cur.rowcount
+        rows_loaded = rows_copied
+        if config["on_conflict"] is not None:
+            cur.execute(f"INSERT INTO {config['target']} ({target_columns}) \
+                SELECT {target_columns} FROM {copy_target} ON CONFLICT {config['on_conflict']}")
+            rows_loaded = cur.rowcount
+        elif config["match_columns"] is not None:
+            matches = " AND ".join(f"loaded.{column} = staged.{column}"
+                                   for column in config["match_columns"])
+            cur.execute(f"INSERT INTO {config['target']} ({target_columns}) \
+                SELECT {target_columns} FROM {copy_target} AS staged WHERE NOT EXISTS \
+                (SELECT 1 FROM {config['target']} AS loaded WHERE {matches})")
+            rows_loaded = cur.rowcount
+        if staged:
+            cur.execute(f"DROP TABLE {copy_target}")
+    short_conn.rollback()
+    return {"rows_copied": rows_copied, "rows_loaded": rows_loaded,
+            "bytes": buffer.bytes_transferred, "seconds": time.perf_counter() - start}
+
+
+def print_transfer(table: str, result: dict) -> None:
+    """Prints a table's transfer size and throughput"""
+    rows_per_second = result["rows_copied"] / result["seconds"] if result["seconds"] > 0 else 0
+    print(f"{table}: {result['rows_copied']} rows copied, {result['rows_loaded']} loaded, "
+          f"{result['bytes'] / 1e6:.1f} MB in {result['seconds']:.2f}s "
+          f"({rows_per_second:,.0f} rows/s)")